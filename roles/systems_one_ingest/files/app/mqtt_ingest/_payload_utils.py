@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+from typing import Any
+
+
+def _safe_str(value: Any) -> str | None:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value
+    try:
+        return str(value)
+    except Exception:
+        return None
+
+
+def _safe_int(value: Any) -> int | None:
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value)
+    except Exception:
+        return None
+
+
+def _safe_int_or_zero(value: Any) -> int:
+    # JSON counters are almost always plain ints (or null); handle those without
+    # the call + try/except in _safe_int.
+    if type(value) is int:
+        return value
+    if value is None:
+        return 0
+    parsed = _safe_int(value)
+    return 0 if parsed is None else parsed
+
+
+def _safe_float(value: Any) -> float | None:
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return float(int(value))
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except Exception:
+        return None
+
+
+def _json_float(value: Any) -> float | None:
+    # Same result as _safe_float, but JSON numbers (int/float) and null return
+    # without the isinstance chain; anything else takes the _safe_float path.
+    t = type(value)
+    if t is float:
+        return value
+    if t is int:
+        return float(value)
+    if value is None:
+        return None
+    return _safe_float(value)
+
+
+def _json_str(value: Any) -> str | None:
+    # Same result as _safe_str, with a fast path for JSON strings and null.
+    if value is None or type(value) is str:
+        return value
+    return _safe_str(value)
+
+
+def _normalize_status(value: Any) -> str | None:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        v = value.strip().lower()
+    else:
+        try:
+            v = str(value).strip().lower()
+        except Exception:
+            return None
+
+    if v in {"online", "offline"}:
+        return v
+    return None
@@ -2,8 +2,28 @@ from __future__ import annotations
 
 import logging
 import os
-from dataclasses import dataclass
-from typing import Optional
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+try:
+    import pyodbc  # type: ignore
+except ModuleNotFoundError:
+    # Reported with a helpful message on first connect().
+    pyodbc = None
+
+# Accepted spellings for boolean-ish DB_* settings and the encrypt mode.
+_TRUE_VALUES = frozenset({"1", "true", "yes", "y", "on"})
+_FALSE_VALUES = frozenset({"0", "false", "no", "n", "off", "disable", "disabled"})
+_ENCRYPT_REQUIRED_VALUES = _TRUE_VALUES | {"required"}
+
+_T = TypeVar("_T")
 
 
 @dataclass(frozen=True)
@@ -27,11 +47,80 @@ class MSSQLConnectionParams:
 
     connect_timeout_seconds: int = 5
 
+    # Autocommit for new connections. Batched writers open an explicit
+    # transaction with MSSQLConnector.transaction() either way.
+    autocommit: bool = True
+
+    # ODBC driver-manager pooling (pyodbc.pooling). Lets unixODBC reuse idle
+    # handles for the same connection string instead of a full TCP+TLS+login.
+    # Must be decided before the first connection in the process.
+    odbc_pooling: bool = True
+
+    # Connection pool used by lease(): at most pool_size live connections,
+    # callers wait up to pool_timeout_seconds for one to be returned.
+    pool_size: int = 4
+    pool_timeout_seconds: float = 30.0
+    # Connections opened up front by warmup(), and the floor the pruner keeps.
+    pool_min_size: int = 1
+    # Idle connections unused for longer than this are closed in the
+    # background (never below pool_min_size). 0 disables pruning.
+    pool_max_idle_seconds: float = 300.0
+
+
+@dataclass(frozen=True)
+class _IdleConnection:
+    conn: Any
+    released_at: float
+
+
+@dataclass(slots=True)
+class _Transaction:
+    # Callbacks registered with after_commit(), run once the commit succeeds.
+    on_commit: list[Callable[[], None]] = field(default_factory=list)
+    # Set when a failed write left the server without an open transaction
+    # (deadlock victim, XACT_ABORT, ...): its earlier writes are already gone.
+    lost: bool = False
+
+
+class CommitUnknownError(Exception):
+    """The connection was lost during COMMIT: the writes may or may not be stored."""
+
 
 class MSSQLConnector:
     def __init__(self, params: MSSQLConnectionParams) -> None:
         self._logger = logging.getLogger("mqtt_ingest.mssql")
         self._params = params
+        # Params are frozen, so the connection string never changes. Building it
+        # once also keeps the driver-manager pool key identical across connects.
+        self._conn_str = self._build_connection_string()
+
+        if pyodbc is not None:
+            pyodbc.pooling = bool(params.odbc_pooling)
+
+        # Idle connections are a LIFO stack so the most recently used (warmest)
+        # connection is handed out first. When the pool is exhausted, callers
+        # queue up FIFO and a returned connection goes straight to the oldest
+        # waiter, so nobody starves under saturation.
+        self._idle: deque[_IdleConnection] = deque()
+        self._waiters: queue.SimpleQueue[Future[Any]] = queue.SimpleQueue()
+        self._max_size = max(1, int(params.pool_size))
+        self._pool_lock = threading.Lock()
+        self._pool_open = 0
+        self._pool_closed = False
+
+        # The pruner starts on the first checkin, so connectors that only ever
+        # connect() directly (health check, diagnostics scripts) never run one.
+        self._prune_stop = threading.Event()
+        self._prune_thread: Optional[threading.Thread] = None
+        self._prune_pending = params.pool_max_idle_seconds > 0
+
+        # Per-connection statement cursors handed out by cursor_for().
+        self._statement_cursors: dict[int, dict[str, Any]] = {}
+        # Connections currently inside transaction(), so nested use joins it.
+        self._transactions: dict[int, _Transaction] = {}
+        # The connection this thread is already leasing, so nested lease() reuses
+        # it, and the open event_transaction() (an ExitStack) if there is one.
+        self._local = threading.local()
 
     def connect(self):
         """Create and return a live pyodbc connection.
@@ -39,14 +128,10 @@ class MSSQLConnector:
         Raises a helpful error if pyodbc isn't installed.
         """
 
-        try:
-            import pyodbc  # type: ignore
-        except ModuleNotFoundError as exc:
+        if pyodbc is None:
             raise ModuleNotFoundError(
                 "pyodbc is not installed. Add it to requirements and install dependencies."
-            ) from exc
-
-        conn_str = self._build_connection_string()
+            )
 
         self._logger.info(
             "Connecting to MSSQL %s:%s db=%s driver=%s",
@@ -56,11 +141,471 @@ class MSSQLConnector:
             self._params.driver,
         )
 
-        # autocommit=True is convenient for simple health checks.
+        # autocommit=True (the default) is convenient for simple health checks.
         return pyodbc.connect(
-            conn_str, timeout=self._params.connect_timeout_seconds, autocommit=True
+            self._conn_str,
+            timeout=self._params.connect_timeout_seconds,
+            autocommit=self._params.autocommit,
         )
 
+    @contextmanager
+    def lease(self) -> Iterator[Any]:
+        """Borrow a pooled connection for the duration of the with-block.
+
+        The connection goes back to the pool on normal exit. If the block raises,
+        the connection is closed and dropped instead, since it may be broken.
+        A nested lease() on the same thread gets the outer connection, so store
+        calls made inside event_transaction() share its transaction.
+        """
+
+        held = getattr(self._local, "conn", None)
+        if held is None:
+            event = getattr(self._local, "event", None)
+            if event is None:
+                with self._lease_new() as conn:
+                    yield conn
+                return
+            # First write of an event_transaction(): lease its connection and
+            # begin the transaction now; both end with the event.
+            held = event.enter_context(self._begin_event())
+
+        txn = self._transactions.get(id(held))
+        if txn is None:
+            yield held
+            return
+        if txn.lost:
+            raise RuntimeError("MSSQL transaction was already rolled back")
+        try:
+            yield held
+        except Exception:
+            self._check_transaction(held, txn)
+            raise
+
+    @contextmanager
+    def _lease_new(self) -> Iterator[Any]:
+        conn = self._checkout()
+        self._local.conn = conn
+        try:
+            yield conn
+        except BaseException:
+            self._local.conn = None
+            self._discard(conn)
+            raise
+        self._local.conn = None
+        self._checkin(conn)
+
+    @contextmanager
+    def event_transaction(self) -> Iterator[None]:
+        """Run every store write made in the with-block as one transaction.
+
+        Nothing happens up front: the first lease() in the block checks out a
+        connection and begins the transaction, later ones share it and their
+        own transaction() joins it, so all writes for one MQTT message cost a
+        single commit. A block whose writes were all skipped (state cache
+        hits) never leases a connection or commits. A write that fails inside
+        the block normally only loses its own statement. If the server rolled
+        the whole transaction back (deadlock, XACT_ABORT), later writes in the
+        block and the commit raise instead of running in a new transaction.
+        """
+
+        if (
+            getattr(self._local, "event", None) is not None
+            or getattr(self._local, "conn", None) is not None
+        ):
+            # Already inside an event or a lease: writes join that one.
+            yield
+            return
+
+        self._local.event = ExitStack()
+        try:
+            with self._local.event:
+                yield
+        finally:
+            self._local.event = None
+
+    @contextmanager
+    def _begin_event(self) -> Iterator[Any]:
+        with self._lease_new() as conn, self.transaction(conn):
+            yield conn
+
+    def call(self, op: Callable[[Any], _T], *, idempotent: bool = True) -> _T:
+        """Run op(conn) on a leased connection, retrying once if the connection died.
+
+        A stale pooled connection then costs a reconnect instead of a failed
+        event. An idempotent op (upserts) is retried even if the first attempt
+        may have been applied. With idempotent=False, op must write inside
+        transaction(); it is retried only if the connection died before the
+        commit was sent, and a lost commit raises CommitUnknownError.
+
+        The first write of an event_transaction() is retried the same way:
+        it began the transaction, so nothing else has been written on it yet.
+        """
+
+        if getattr(self._local, "conn", None) is not None:
+            # Inside an outer lease: a retry on another connection would run
+            # outside its transaction, so leave error handling to the caller.
+            with self.lease() as conn:
+                return op(conn)
+
+        event = getattr(self._local, "event", None)
+        try:
+            with self.lease() as conn:
+                return op(conn)
+        except Exception as exc:
+            if not is_connection_error(exc):
+                raise
+            if not idempotent and isinstance(exc, CommitUnknownError):
+                raise
+            if event is not None:
+                # Roll back and discard the event's dead connection; the retry's
+                # lease() begins the transaction again on a new one.
+                event.pop_all().__exit__(type(exc), exc, exc.__traceback__)
+            self._logger.warning(
+                "MSSQL connection lost (%s); retrying once on a new connection", exc
+            )
+        with self.lease() as conn:
+            return op(conn)
+
+    @contextmanager
+    def transaction(self, conn: Any) -> Iterator[Any]:
+        """Run the with-block as a single transaction on ``conn``.
+
+        Commits on success and rolls back if the block raises, so N writes cost
+        one commit (one log flush) instead of one each under autocommit. The
+        connection's autocommit setting is restored afterwards. Nested use on
+        the same connection joins the outer transaction. If the connection
+        drops during the commit, CommitUnknownError is raised.
+        """
+
+        key = id(conn)
+        if key in self._transactions:
+            yield conn
+            return
+
+        txn = self._transactions[key] = _Transaction()
+        autocommit = conn.autocommit
+        conn.autocommit = False
+        try:
+            yield conn
+            if txn.lost:
+                raise RuntimeError("MSSQL transaction was rolled back by the server")
+            try:
+                conn.commit()
+            except Exception as exc:
+                if is_connection_error(exc):
+                    raise CommitUnknownError(
+                        "MSSQL connection lost during COMMIT"
+                    ) from exc
+                raise
+        except BaseException:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            self._transactions.pop(key, None)
+            try:
+                conn.autocommit = autocommit
+            except Exception:
+                pass
+
+        for callback in txn.on_commit:
+            try:
+                callback()
+            except Exception:
+                self._logger.exception("MSSQL after-commit callback failed")
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """Run ``callback`` once the transaction this thread is in commits.
+
+        Outside a transaction (autocommit) it runs immediately; if the
+        transaction rolls back it never runs. Stores use this to update their
+        caches only with rows that were actually committed.
+        """
+
+        held = getattr(self._local, "conn", None)
+        txn = None if held is None else self._transactions.get(id(held))
+        if txn is None:
+            callback()
+        else:
+            txn.on_commit.append(callback)
+
+    def _check_transaction(self, conn: Any, txn: _Transaction) -> None:
+        # After a failed write: is the transaction still open? Once the server
+        # has rolled it back, the next statement would silently start (and the
+        # commit would keep) a new one.
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT XACT_STATE()")
+            row = cur.fetchone()
+            txn.lost = not row or row[0] != 1
+        except Exception:
+            txn.lost = True
+
+    def cursor_for(self, conn: Any, sql: str) -> Any:
+        """Return the cursor reserved for ``sql`` on a leased connection.
+
+        pyodbc only calls SQLPrepare when a cursor executes a different SQL
+        string than last time, so re-executing the same statement on the same
+        cursor reuses the prepared handle (sp_prepexec once, then sp_execute
+        with just the parameters). Dropped when the pool discards ``conn``.
+        """
+
+        cursors = self._statement_cursors.setdefault(id(conn), {})
+        cur = cursors.get(sql)
+        if cur is None:
+            cur = cursors[sql] = conn.cursor()
+        return cur
+
+    def warmup(self) -> int:
+        """Open pool_min_size connections in parallel and park them in the pool.
+
+        Moves the connect/TLS/login cost out of the first message and surfaces
+        misconfiguration at startup. Returns the number of connections opened.
+        """
+
+        target = min(int(self._params.pool_min_size), int(self._params.pool_size))
+        opened: list[Any] = []
+        errors: list[BaseException] = []
+
+        def _open() -> None:
+            try:
+                conn = self.connect()
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            except BaseException as exc:
+                self._release_slot()
+                errors.append(exc)
+                return
+            opened.append(conn)
+
+        threads: list[threading.Thread] = []
+        for _ in range(max(0, target - len(self._idle))):
+            if not self._reserve_slot():
+                break
+            thread = threading.Thread(target=_open, name="mssql-warmup", daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        for conn in opened:
+            self._checkin(conn)
+
+        if errors and not opened:
+            raise errors[0]
+
+        self._logger.info("MSSQL pool warmed up (%s connections)", len(opened))
+        return len(opened)
+
+    def close(self) -> None:
+        """Close all idle pooled connections; leased ones close on return."""
+
+        with self._pool_lock:
+            self._pool_closed = True
+            idle = [entry.conn for entry in self._idle]
+            self._idle.clear()
+            waiters = self._drain_waiters()
+
+        self._prune_stop.set()
+
+        for waiter in waiters:
+            waiter.set_exception(RuntimeError("MSSQL connection pool is closed"))
+        for conn in idle:
+            self._discard(conn)
+
+    def _checkout(self) -> Any:
+        deadline = time.monotonic() + self._params.pool_timeout_seconds
+        try:
+            # Fast path without the lock: deque.pop() is atomic in CPython.
+            conn = self._idle.pop().conn
+        except IndexError:
+            conn = self._checkout_slow(deadline)
+
+        if conn is None:
+            # We hold a free slot (reserved above or handed over by a
+            # discard): fill it with a new connection.
+            try:
+                return self.connect()
+            except BaseException:
+                self._release_slot()
+                raise
+
+        # No liveness probe: conn.cursor() never reaches the server, so it
+        # can't spot a dead connection anyway. call() retries on a fresh
+        # connection instead, and the pruner retires long-idle ones.
+        return conn
+
+    def _checkout_slow(self, deadline: float) -> Any:
+        # Returns an idle connection, or None if the caller now owns a free slot.
+        waiter: Future[Any] = Future()
+        with self._pool_lock:
+            if self._pool_closed:
+                raise RuntimeError("MSSQL connection pool is closed")
+            if self._idle:
+                return self._idle.pop().conn
+            if self._pool_open < self._max_size:
+                self._pool_open += 1
+                return None
+            self._waiters.put(waiter)
+
+        # _checkin() pushes without the lock, so a connection can land between
+        # the idle check above and the put. Re-check now that we're queued:
+        # either its waiter check saw us or we see its connection.
+        if self._idle:
+            self._settle_idle()
+        return self._wait_for_handoff(waiter, deadline)
+
+    def _wait_for_handoff(self, waiter: Future[Any], deadline: float) -> Any:
+        try:
+            return waiter.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            if waiter.cancel():
+                raise TimeoutError("Timed out waiting for a pooled MSSQL connection") from None
+            # A connection was handed over just as we gave up; take it.
+            return waiter.result()
+
+    def _checkin(self, conn: Any) -> None:
+        if self._prune_pending:
+            self._start_pruner()
+        if not self._pool_closed and self._waiters.empty():
+            # Fast path without the lock: nobody is waiting, push it back.
+            self._idle.append(_IdleConnection(conn, time.monotonic()))
+            # A waiter re-checks the stack after queueing (see _checkout_slow),
+            # and close() drains the stack under the lock. Re-checking after the
+            # push means either they see this connection or we see them.
+            if not self._pool_closed and self._waiters.empty():
+                return
+            self._settle_idle()
+            return
+
+        with self._pool_lock:
+            closed = self._pool_closed
+            waiter = None if closed else self._next_waiter()
+            if not closed and waiter is None:
+                self._idle.append(_IdleConnection(conn, time.monotonic()))
+                return
+
+        if waiter is None:
+            self._discard(conn)
+            return
+        waiter.set_result(conn)
+
+    def _settle_idle(self) -> None:
+        # Hand idle connections to queued waiters, or close them if the pool closed.
+        handoffs: list[tuple[Future[Any], Any]] = []
+        with self._pool_lock:
+            if self._pool_closed:
+                stale = [entry.conn for entry in self._idle]
+                self._idle.clear()
+            else:
+                stale = []
+                while self._idle:
+                    waiter = self._next_waiter()
+                    if waiter is None:
+                        break
+                    handoffs.append((waiter, self._idle.pop().conn))
+
+        for waiter, conn in handoffs:
+            waiter.set_result(conn)
+        for conn in stale:
+            self._discard(conn)
+
+    def _start_pruner(self) -> None:
+        with self._pool_lock:
+            if not self._prune_pending:
+                return
+            self._prune_pending = False
+            if self._pool_closed:
+                return
+            self._prune_thread = threading.Thread(
+                target=self._prune_loop, name="mssql-pool-pruner", daemon=True
+            )
+            self._prune_thread.start()
+
+    def _prune_loop(self) -> None:
+        max_idle = float(self._params.pool_max_idle_seconds)
+        while not self._prune_stop.wait(min(30.0, max_idle / 2)):
+            try:
+                pruned = self._prune_idle(max_idle)
+            except Exception:
+                self._logger.exception("MSSQL pool prune failed")
+                continue
+            if pruned:
+                self._logger.info("Closed %s idle MSSQL connections", pruned)
+
+    def _prune_idle(self, max_idle: float) -> int:
+        cutoff = time.monotonic() - max_idle
+        min_size = max(0, int(self._params.pool_min_size))
+        stale: list[Any] = []
+        with self._pool_lock:
+            # The stack is pushed on the right, so the longest-idle entries are
+            # on the left. Checkout pops from the right without the lock, so
+            # take entries one at a time and put back the first fresh one.
+            while self._pool_open - len(stale) > min_size:
+                try:
+                    entry = self._idle.popleft()
+                except IndexError:
+                    break
+                if entry.released_at > cutoff:
+                    self._idle.appendleft(entry)
+                    break
+                stale.append(entry.conn)
+
+        for conn in stale:
+            self._discard(conn)
+        return len(stale)
+
+    def _discard(self, conn: Any) -> None:
+        self._statement_cursors.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._release_slot()
+
+    def _reserve_slot(self) -> bool:
+        with self._pool_lock:
+            if self._pool_closed:
+                raise RuntimeError("MSSQL connection pool is closed")
+            if self._pool_open >= self._max_size:
+                return False
+            self._pool_open += 1
+            return True
+
+    def _release_slot(self) -> None:
+        with self._pool_lock:
+            waiter = None if self._pool_closed else self._next_waiter()
+            if waiter is None:
+                if self._pool_open > 0:
+                    self._pool_open -= 1
+                return
+
+        # Pass the slot on instead of freeing it; the waiter opens a new connection.
+        waiter.set_result(None)
+
+    def _next_waiter(self) -> Optional[Future[Any]]:
+        # Caller holds _pool_lock. Skips waiters that already timed out.
+        while True:
+            try:
+                waiter = self._waiters.get_nowait()
+            except queue.Empty:
+                return None
+            if waiter.set_running_or_notify_cancel():
+                return waiter
+
+    def _drain_waiters(self) -> list[Future[Any]]:
+        # Caller holds _pool_lock.
+        waiters: list[Future[Any]] = []
+        while True:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return waiters
+            waiters.append(waiter)
+
     def test_connection(self) -> None:
         """Connect and run a simple query (SELECT 1)."""
 
@@ -83,14 +628,14 @@ class MSSQLConnector:
         server = f"{p.host},{int(p.port)}" if p.port else p.host
 
         encrypt_mode = (p.encrypt or "optional").strip().lower()
-        if encrypt_mode in {"1", "true", "yes", "y", "on", "required"}:
+        if encrypt_mode in _ENCRYPT_REQUIRED_VALUES:
             encrypt = "yes"
             trust = (
                 "no"
                 if p.trust_server_certificate is None
                 else ("yes" if p.trust_server_certificate else "no")
             )
-        elif encrypt_mode in {"0", "false", "no", "n", "off", "disable", "disabled"}:
+        elif encrypt_mode in _FALSE_VALUES:
             encrypt = "no"
             trust = (
                 "no"
@@ -123,7 +668,19 @@ class MSSQLConnector:
         return ";".join(parts) + ";"
 
 
+def is_connection_error(exc: BaseException) -> bool:
+    """True for pyodbc errors that mean the connection itself is unusable."""
+
+    if isinstance(exc, CommitUnknownError):
+        return True
+    if pyodbc is None:
+        return False
+    return isinstance(exc, (pyodbc.OperationalError, pyodbc.InterfaceError))
+
+
 def mssql_params_from_env() -> MSSQLConnectionParams:
+    """Build connection params from DB_* environment variables."""
+
     def _get(name: str, default: str = "") -> str:
         return os.getenv(name, default).strip()
 
@@ -147,7 +704,7 @@ def mssql_params_from_env() -> MSSQLConnectionParams:
     trust_raw = _get("DB_TRUST_SERVER_CERT", "")
     trust_server_certificate: Optional[bool]
     if trust_raw:
-        trust_server_certificate = trust_raw.lower() in {"1", "true", "yes", "y", "on"}
+        trust_server_certificate = trust_raw.lower() in _TRUE_VALUES
     else:
         trust_server_certificate = None
 
@@ -162,6 +719,27 @@ def mssql_params_from_env() -> MSSQLConnectionParams:
     except ValueError:
         connect_timeout_seconds = 5
 
+    odbc_pooling_raw = _get("DB_ODBC_POOLING", "true")
+    odbc_pooling = odbc_pooling_raw.lower() in _TRUE_VALUES
+
+    pool_size_raw = _get("DB_INGEST_POOL_SIZE", "4")
+    try:
+        pool_size = max(1, int(pool_size_raw))
+    except ValueError:
+        pool_size = 4
+
+    pool_min_size_raw = _get("DB_POOL_MIN_SIZE", "1")
+    try:
+        pool_min_size = max(0, int(pool_min_size_raw))
+    except ValueError:
+        pool_min_size = 1
+
+    max_idle_raw = _get("DB_POOL_MAX_IDLE_SECONDS", "300")
+    try:
+        pool_max_idle_seconds = max(0.0, float(max_idle_raw))
+    except ValueError:
+        pool_max_idle_seconds = 300.0
+
     return MSSQLConnectionParams(
         host=host,
         port=port,
@@ -172,4 +750,8 @@ def mssql_params_from_env() -> MSSQLConnectionParams:
         encrypt=encrypt,
         trust_server_certificate=trust_server_certificate,
         connect_timeout_seconds=connect_timeout_seconds,
+        odbc_pooling=odbc_pooling,
+        pool_size=pool_size,
+        pool_min_size=pool_min_size,
+        pool_max_idle_seconds=pool_max_idle_seconds,
     )
@@ -2,14 +2,17 @@ from __future__ import annotations
 
 import logging
 from dataclasses import dataclass
-from datetime import datetime, timezone
-from typing import Any, Mapping, Optional
+from datetime import datetime
+from typing import Any, Optional
 
+from ._payload_utils import _safe_str
 from .db_client import MSSQLConnector
-from .ingest_models import IngestEvent
+from .ingest_models import IngestEvent, SubtypeTag
+from .state_cache import UpsertStateCache
+from .time_utils import event_timestamp
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class DeviceOsStatusUpsertResult:
     device_os_status_id: int
     created: bool
@@ -31,30 +34,38 @@ class DeviceOsStatusStore:
       - Only processes events with subtype == "status" and payload.device_os_version.
       - One row per device_id (assumed). If missing, inserts.
       - Updates updated_at on every status packet that includes device_os_version.
+      - Insert-or-update is a single MERGE round-trip.
+      - A packet repeating the cached os_version skips the MERGE; its timestamps
+        are refreshed in a batch every refresh_interval_seconds.
     """
 
-    def __init__(self, connector: MSSQLConnector) -> None:
+    def __init__(
+        self, connector: MSSQLConnector, *, refresh_interval_seconds: float = 60.0
+    ) -> None:
         self._logger = logging.getLogger("mqtt_ingest.device_os_status")
         self._connector = connector
-        self._conn: Any | None = None
+        self._state = UpsertStateCache(
+            connector,
+            name="device_os_status",
+            touch_sql="""
+                UPDATE dbo.device_os_status
+                SET ts_epoch = ?, ts_datetime = ?, updated_at = SYSUTCDATETIME()
+                WHERE id = ?
+                """,
+            refresh_interval_seconds=refresh_interval_seconds,
+        )
 
     def close(self) -> None:
-        if self._conn is None:
-            return
-        try:
-            self._conn.close()
-        except Exception:
-            pass
-        self._conn = None
+        self._state.close()
 
     def ensure_from_event(
         self, event: IngestEvent, *, device_id: int
     ) -> Optional[DeviceOsStatusUpsertResult]:
-        if (event.subtype or "") != "status":
+        if event.subtype_tag != SubtypeTag.STATUS:
             return None
 
         payload = event.payload
-        if not isinstance(payload, Mapping):
+        if not isinstance(payload, dict):
             return None
 
         os_raw = payload.get("device_os_version")
@@ -66,7 +77,7 @@ class DeviceOsStatusStore:
         if not os_version:
             return None
 
-        ts_epoch, ts_dt = _event_timestamp(event)
+        ts_epoch, ts_dt = event_timestamp(event)
 
         return self.upsert_os_version(
             device_id=int(device_id),
@@ -83,38 +94,42 @@ class DeviceOsStatusStore:
         ts_epoch: int,
         ts_datetime: datetime,
     ) -> DeviceOsStatusUpsertResult:
-        conn = self._get_conn()
-
-        row = self._select_by_device_id(conn, device_id)
-        if row is None:
-            os_status_id = self._insert_os_status(
-                conn,
-                device_id=device_id,
-                os_version=os_version,
-                ts_epoch=ts_epoch,
-                ts_datetime=ts_datetime,
+        cached_id = self._state.lookup(
+            device_id, os_version, ts_epoch=ts_epoch, ts_datetime=ts_datetime
+        )
+        if cached_id is not None:
+            self._logger.debug("Device OS unchanged device_id=%s", device_id)
+            return DeviceOsStatusUpsertResult(
+                device_os_status_id=cached_id, created=False
             )
+
+        try:
+            # The MERGE is idempotent, so call() may retry it on a fresh
+            # connection if the pooled one went stale.
+            os_status_id, created, prev_os = self._connector.call(
+                lambda conn: self._merge_os_status(
+                    conn,
+                    device_id=device_id,
+                    os_version=os_version,
+                    ts_epoch=ts_epoch,
+                    ts_datetime=ts_datetime,
+                )
+            )
+        except Exception:
+            self._state.forget(device_id)
+            raise
+        # Cache only once committed (see DeviceStatusStore.upsert_status).
+        self._connector.after_commit(
+            lambda: self._state.remember(device_id, os_status_id, os_version)
+        )
+
+        if created:
             self._logger.info(
                 "Device OS inserted id=%s device_id=%s",
                 os_status_id,
                 device_id,
             )
-            return DeviceOsStatusUpsertResult(
-                device_os_status_id=os_status_id, created=True
-            )
-
-        os_status_id = int(row[0])
-        prev_os = _safe_str(row[1])
-
-        self._update_os_status(
-            conn,
-            os_status_id=os_status_id,
-            os_version=os_version,
-            ts_epoch=ts_epoch,
-            ts_datetime=ts_datetime,
-        )
-
-        if (prev_os or "") != os_version:
+        elif (prev_os or "") != os_version:
             self._logger.info(
                 "Device OS changed device_id=%s",
                 device_id,
@@ -126,31 +141,10 @@ class DeviceOsStatusStore:
             )
 
         return DeviceOsStatusUpsertResult(
-            device_os_status_id=os_status_id, created=False
-        )
-
-    def _get_conn(self) -> Any:
-        if self._conn is None:
-            self._conn = self._connector.connect()
-            return self._conn
-
-        try:
-            self._conn.cursor()
-        except Exception:
-            self.close()
-            self._conn = self._connector.connect()
-
-        return self._conn
-
-    def _select_by_device_id(self, conn: Any, device_id: int) -> Any:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, os_version FROM dbo.device_os_status WHERE device_id = ?",
-            (int(device_id),),
+            device_os_status_id=os_status_id, created=created
         )
-        return cur.fetchone()
 
-    def _insert_os_status(
+    def _merge_os_status(
         self,
         conn: Any,
         *,
@@ -158,67 +152,47 @@ class DeviceOsStatusStore:
         os_version: str,
         ts_epoch: int,
         ts_datetime: datetime,
-    ) -> int:
-        cur = conn.cursor()
-        cur.execute(
+    ) -> tuple[int, bool, Optional[str]]:
+        """Insert-or-update in one round-trip.
+
+        Returns (id, created, previous os_version).
+        """
+
+        sql = """
+            MERGE dbo.device_os_status WITH (HOLDLOCK) AS tgt
+            USING (VALUES (?, ?, ?, ?)) AS src (device_id, os_version, ts_epoch, ts_datetime)
+                ON tgt.device_id = src.device_id
+            WHEN MATCHED THEN
+                UPDATE SET
+                    os_version = src.os_version,
+                    ts_epoch = src.ts_epoch,
+                    ts_datetime = src.ts_datetime,
+                    updated_at = SYSUTCDATETIME()
+            WHEN NOT MATCHED THEN
+                INSERT (
+                    device_id,
+                    os_version,
+                    ts_epoch,
+                    ts_datetime,
+                    created_at,
+                    updated_at
+                )
+                VALUES (
+                    src.device_id,
+                    src.os_version,
+                    src.ts_epoch,
+                    src.ts_datetime,
+                    SYSUTCDATETIME(),
+                    SYSUTCDATETIME()
+                )
+            OUTPUT Inserted.id, $action, Deleted.os_version;
             """
-            INSERT INTO dbo.device_os_status (
-                device_id,
-                os_version,
-                ts_epoch,
-                ts_datetime,
-                created_at,
-                updated_at
-            )
-            OUTPUT Inserted.id
-            VALUES (?, ?, ?, ?, SYSUTCDATETIME(), SYSUTCDATETIME())
-            """,
+        cur = self._connector.cursor_for(conn, sql)
+        cur.execute(
+            sql,
             (int(device_id), os_version, int(ts_epoch), ts_datetime),
         )
         row = cur.fetchone()
         if not row or row[0] is None:
-            raise RuntimeError("Insert succeeded but no id returned")
-        return int(row[0])
-
-    def _update_os_status(
-        self,
-        conn: Any,
-        *,
-        os_status_id: int,
-        os_version: str,
-        ts_epoch: int,
-        ts_datetime: datetime,
-    ) -> None:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            UPDATE dbo.device_os_status
-            SET os_version = ?,
-                ts_epoch = ?,
-                ts_datetime = ?,
-                updated_at = SYSUTCDATETIME()
-            WHERE id = ?
-            """,
-            (os_version, int(ts_epoch), ts_datetime, int(os_status_id)),
-        )
-
-
-def _event_timestamp(event: IngestEvent) -> tuple[int, datetime]:
-    if event.ts_ms is not None:
-        ts_dt = datetime.fromtimestamp(event.ts_ms / 1000.0, tz=timezone.utc)
-        ts_epoch = int(event.ts_ms // 1000)
-        return ts_epoch, ts_dt
-
-    now = datetime.now(timezone.utc)
-    return int(now.timestamp()), now
-
-
-def _safe_str(value: Any) -> Optional[str]:
-    if value is None:
-        return None
-    if isinstance(value, str):
-        return value
-    try:
-        return str(value)
-    except Exception:
-        return None
+            raise RuntimeError("Merge succeeded but no id returned")
+        return int(row[0]), row[1] == "INSERT", _safe_str(row[2])
@@ -1,17 +1,13 @@
 from __future__ import annotations
 
 import logging
-from dataclasses import dataclass
-from datetime import datetime, timezone
-from typing import Any, Mapping, Optional, cast
+import threading
+from typing import Any
 
-from .db_client import MSSQLConnector
-from .ingest_models import IngestEvent
-
-
-@dataclass(frozen=True)
-class DeviceStatisticsInsertResult:
-    device_statistics_id: int
+from ._payload_utils import _safe_int_or_zero
+from .db_client import CommitUnknownError, MSSQLConnector, is_connection_error
+from .ingest_models import IngestEvent, SubtypeTag
+from .time_utils import event_timestamp
 
 
 class DeviceStatisticsStore:
@@ -38,118 +34,251 @@ class DeviceStatisticsStore:
     Behavior:
       - Only processes events with subtype == "statistics" and payload.statistics.
       - Every new message inserts a new row (no upsert).
+      - With batch_size > 1, rows are buffered and written in one batch by a
+        background thread once batch_size rows are pending or every
+        flush_interval_seconds, whichever comes first. Batches never run inside
+        an event's transaction, so another device's rollback can't lose them.
+      - A batch that fails on a lost connection before its commit was sent goes
+        back on the queue (at most max_pending_rows are kept). If the commit
+        itself was lost the rows may already be stored, so they are dropped
+        rather than inserted twice. A batch that fails on bad data is retried
+        row by row so only the offending rows are dropped.
+      - Batches go to dbo.insert_device_statistics_batch as one table-valued
+        parameter (one round-trip). If that procedure doesn't exist yet (or
+        use_tvp=False) they fall back to executemany (fast_executemany).
     """
 
-    def __init__(self, connector: MSSQLConnector) -> None:
+    def __init__(
+        self,
+        connector: MSSQLConnector,
+        *,
+        batch_size: int = 1,
+        flush_interval_seconds: float = 5.0,
+        use_tvp: bool = True,
+        max_pending_rows: int = 10000,
+    ) -> None:
         self._logger = logging.getLogger("mqtt_ingest.device_statistics")
         self._connector = connector
-        self._conn: Any | None = None
+
+        self._batch_size = max(1, int(batch_size))
+        self._use_tvp = bool(use_tvp)
+        self._flush_interval_seconds = max(0.1, float(flush_interval_seconds))
+        self._max_pending_rows = max(self._batch_size, int(max_pending_rows))
+        self._pending: list[tuple[Any, ...]] = []
+        self._pending_lock = threading.Lock()
+        self._flush_stop = threading.Event()
+        # Set when a full batch is waiting, so the flush thread writes it now.
+        self._flush_wake = threading.Event()
+        self._flush_thread: threading.Thread | None = None
+
+        if self._batch_size > 1:
+            self._flush_thread = threading.Thread(
+                target=self._flush_loop,
+                name="device-statistics-flush",
+                daemon=True,
+            )
+            self._flush_thread.start()
 
     def close(self) -> None:
-        if self._conn is None:
-            return
+        self._flush_stop.set()
+        self._flush_wake.set()
+        if self._flush_thread is not None:
+            self._flush_thread.join(timeout=self._flush_interval_seconds + 1.0)
+            self._flush_thread = None
+
         try:
-            self._conn.close()
+            self.flush()
         except Exception:
-            pass
-        self._conn = None
+            self._logger.exception("Statistics flush on close failed")
+
+    def insert_from_event(self, event: IngestEvent, *, device_id: int) -> bool:
+        """Insert (or queue) the event's statistics row; False if it has none."""
 
-    def insert_from_event(
-        self, event: IngestEvent, *, device_id: int
-    ) -> Optional[DeviceStatisticsInsertResult]:
-        if (event.subtype or "") != "statistics":
-            return None
+        if event.subtype_tag != SubtypeTag.STATISTICS:
+            return False
 
         payload = event.payload
-        if not isinstance(payload, Mapping):
-            return None
+        # Payloads come from json.loads, so a plain dict check is enough (and
+        # much cheaper than the Mapping ABC check on every message).
+        if not isinstance(payload, dict):
+            return False
 
         stats = payload.get("statistics")
-        if not isinstance(stats, Mapping):
-            return None
+        if not isinstance(stats, dict):
+            return False
 
-        stats_map = cast(Mapping[str, Any], stats)
+        ts_epoch, ts_dt = event_timestamp(event)
 
-        ts_epoch, ts_dt = _event_timestamp(event)
+        get = stats.get
+        to_int = _safe_int_or_zero
 
         # Map payload keys -> DB columns
-        total_items = _safe_int_or_zero(stats_map.get("total_items"))
-        no_read = _safe_int_or_zero(stats_map.get("no_reads"))
-        good_read = _safe_int_or_zero(stats_map.get("good_reads"))
-        no_dimension = _safe_int_or_zero(stats_map.get("no_dimensions"))
-        no_weight = _safe_int_or_zero(stats_map.get("no_weight"))
+        total_items = to_int(get("total_items"))
+        no_read = to_int(get("no_reads"))
+        good_read = to_int(get("good_reads"))
+        no_dimension = to_int(get("no_dimensions"))
+        no_weight = to_int(get("no_weight"))
 
-        data_sent = _safe_int_or_zero(stats_map.get("sent"))
-        not_sent = _safe_int_or_zero(stats_map.get("not_sent"))
+        data_sent = to_int(get("sent"))
+        not_sent = to_int(get("not_sent"))
 
-        item_out_of_spec = _safe_int_or_zero(stats_map.get("out_of_spec"))
-        more_than_1_item = _safe_int_or_zero(stats_map.get("more_than_one_item"))
+        item_out_of_spec = to_int(get("out_of_spec"))
+        more_than_1_item = to_int(get("more_than_one_item"))
 
         # Some DB schemas declare these as NOT NULL; default to 0.
-        image_sent = _safe_int_or_zero(stats_map.get("image_sent"))
-        image_not_sent = _safe_int_or_zero(stats_map.get("image_not_sent"))
-
-        stats_id = self._insert_statistics(
-            device_id=int(device_id),
-            ts_epoch=ts_epoch,
-            ts_datetime=ts_dt,
-            total_items=total_items,
-            no_read=no_read,
-            good_read=good_read,
-            no_dimension=no_dimension,
-            no_weight=no_weight,
-            data_sent=data_sent,
-            not_sent=not_sent,
-            image_sent=image_sent,
-            image_not_sent=image_not_sent,
-            item_out_of_spec=item_out_of_spec,
-            more_than_1_item=more_than_1_item,
+        image_sent = to_int(get("image_sent"))
+        image_not_sent = to_int(get("image_not_sent"))
+
+        row = (
+            int(device_id),
+            int(ts_epoch),
+            ts_dt,
+            total_items,
+            no_read,
+            good_read,
+            no_dimension,
+            no_weight,
+            data_sent,
+            not_sent,
+            image_sent,
+            image_not_sent,
+            item_out_of_spec,
+            more_than_1_item,
         )
 
-        self._logger.info(
-            "Statistics inserted id=%s device_id=%s ts=%s",
-            stats_id,
+        if self._batch_size <= 1:
+            self._insert_statistics_bulk([row])
+            self._logger.info(
+                "Statistics inserted device_id=%s ts=%s",
+                device_id,
+                ts_epoch,
+            )
+            return True
+
+        with self._pending_lock:
+            self._pending.append(row)
+            pending = len(self._pending)
+
+        self._logger.debug(
+            "Statistics queued device_id=%s ts=%s pending=%s",
             device_id,
             ts_epoch,
+            pending,
         )
 
-        return DeviceStatisticsInsertResult(device_statistics_id=stats_id)
+        if pending >= self._batch_size:
+            # Written by the flush thread on its own connection, not inside
+            # this event's transaction.
+            self._flush_wake.set()
+
+        return True
+
+    def flush(self) -> int:
+        """Write all queued rows in one batch. Returns the number of rows written.
 
-    def _get_conn(self) -> Any:
-        if self._conn is None:
-            self._conn = self._connector.connect()
-            return self._conn
+        If the connection is lost before the commit (after call()'s reconnect
+        retry) the rows are put back at the front of the queue and the error
+        propagates; if the commit itself was lost they are dropped. Any other
+        failure retries the batch row by row and drops only the rows that fail.
+        """
+
+        with self._pending_lock:
+            rows = self._pending
+            self._pending = []
+
+        if not rows:
+            return 0
 
         try:
-            self._conn.cursor()
-        except Exception:
-            self.close()
-            self._conn = self._connector.connect()
+            self._insert_statistics_bulk(rows)
+        except CommitUnknownError:
+            # The batch may already be stored; requeueing could insert it twice.
+            self._logger.warning(
+                "Lost the commit of %s statistics rows; not retrying", len(rows)
+            )
+            raise
+        except Exception as exc:
+            if is_connection_error(exc):
+                self._requeue(rows)
+                raise
+            self._logger.warning(
+                "Statistics batch of %s rows failed (%s); retrying row by row",
+                len(rows),
+                exc,
+            )
+            written = self._insert_rows_individually(rows)
+        else:
+            written = len(rows)
+
+        self._logger.info("Statistics inserted rows=%s (batched)", written)
+        return written
+
+    def _insert_rows_individually(self, rows: list[tuple[Any, ...]]) -> int:
+        written = 0
+        for index, row in enumerate(rows):
+            try:
+                self._insert_statistics_bulk([row])
+            except Exception as exc:
+                if is_connection_error(exc):
+                    # After a lost commit only the unsent rows are safe to retry.
+                    lost_commit = isinstance(exc, CommitUnknownError)
+                    self._requeue(rows[index + 1 :] if lost_commit else rows[index:])
+                    raise
+                self._logger.warning(
+                    "Dropping statistics row device_id=%s ts=%s: %s", row[0], row[1], exc
+                )
+                continue
+            written += 1
+        return written
+
+    def _requeue(self, rows: list[tuple[Any, ...]]) -> None:
+        # Failed rows are older than anything queued since, so they go first.
+        with self._pending_lock:
+            self._pending[:0] = rows
+            overflow = len(self._pending) - self._max_pending_rows
+            if overflow > 0:
+                del self._pending[:overflow]
+        if overflow > 0:
+            self._logger.warning(
+                "Statistics queue full; dropped the %s oldest rows", overflow
+            )
 
-        return self._conn
+    def _flush_loop(self) -> None:
+        while not self._flush_stop.is_set():
+            self._flush_wake.wait(self._flush_interval_seconds)
+            self._flush_wake.clear()
+            if self._flush_stop.is_set():
+                # close() writes whatever is left.
+                return
+            try:
+                self.flush()
+            except Exception:
+                self._logger.exception("Statistics flush failed")
+
+    def _insert_statistics_bulk(self, rows: list[tuple[Any, ...]]) -> None:
+        # Plain INSERTs aren't idempotent: call() retries on a fresh connection
+        # only if the first attempt died before its commit was sent.
+        self._connector.call(
+            lambda conn: self._write_rows(conn, rows), idempotent=False
+        )
 
-    def _insert_statistics(
-        self,
-        *,
-        device_id: int,
-        ts_epoch: int,
-        ts_datetime: datetime,
-        total_items: int | None,
-        no_read: int | None,
-        good_read: int | None,
-        no_dimension: int | None,
-        no_weight: int | None,
-        data_sent: int | None,
-        not_sent: int | None,
-        image_sent: int | None,
-        image_not_sent: int | None,
-        item_out_of_spec: int | None,
-        more_than_1_item: int | None,
-    ) -> int:
-        conn = self._get_conn()
-        cur = conn.cursor()
-        cur.execute(
-            """
+    def _write_rows(self, conn: Any, rows: list[tuple[Any, ...]]) -> None:
+        if self._use_tvp and len(rows) > 1:
+            try:
+                self._insert_statistics_tvp(conn, rows)
+                return
+            except Exception as exc:
+                # 2812 = could not find stored procedure: the database predates
+                # the bootstrap that adds it. Anything else is a real failure.
+                if "(2812)" not in str(exc):
+                    raise
+                self._use_tvp = False
+                self._logger.warning(
+                    "dbo.insert_device_statistics_batch not found; "
+                    "falling back to executemany for statistics batches"
+                )
+
+        sql = """
             INSERT INTO dbo.device_statistics (
                 device_id,
                 ts_epoch,
@@ -167,55 +296,20 @@ class DeviceStatisticsStore:
                 more_than_1_item,
                 created_at
             )
-            OUTPUT Inserted.id
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, SYSUTCDATETIME())
-            """,
-            (
-                int(device_id),
-                int(ts_epoch),
-                ts_datetime,
-                total_items,
-                no_read,
-                good_read,
-                no_dimension,
-                no_weight,
-                data_sent,
-                not_sent,
-                image_sent,
-                image_not_sent,
-                item_out_of_spec,
-                more_than_1_item,
-            ),
-        )
-        row = cur.fetchone()
-        if not row or row[0] is None:
-            raise RuntimeError("Insert succeeded but no id returned")
-        return int(row[0])
-
-
-def _event_timestamp(event: IngestEvent) -> tuple[int, datetime]:
-    if event.ts_ms is not None:
-        ts_dt = datetime.fromtimestamp(event.ts_ms / 1000.0, tz=timezone.utc)
-        ts_epoch = int(event.ts_ms // 1000)
-        return ts_epoch, ts_dt
-
-    now = datetime.now(timezone.utc)
-    return int(now.timestamp()), now
-
-
-def _safe_int(value: Any) -> int | None:
-    if value is None:
-        return None
-    if isinstance(value, bool):
-        return int(value)
-    if isinstance(value, int):
-        return value
-    try:
-        return int(value)
-    except Exception:
-        return None
-
-
-def _safe_int_or_zero(value: Any) -> int:
-    parsed = _safe_int(value)
-    return 0 if parsed is None else parsed
+            """
+        with self._connector.transaction(conn):
+            cur = self._connector.cursor_for(conn, sql)
+            # Send every parameter set in one batch instead of one round-trip
+            # per row, and commit the batch once. OUTPUT can't be combined with
+            # a bulk insert, so no ids.
+            cur.fast_executemany = True
+            cur.executemany(sql, rows)
+
+    def _insert_statistics_tvp(self, conn: Any, rows: list[tuple[Any, ...]]) -> None:
+        sql = "{CALL dbo.insert_device_statistics_batch(?)}"
+        with self._connector.transaction(conn):
+            cur = self._connector.cursor_for(conn, sql)
+            # pyodbc binds a list of tuples as the procedure's table-valued
+            # parameter, so the whole batch ships in a single request.
+            cur.execute(sql, (rows,))
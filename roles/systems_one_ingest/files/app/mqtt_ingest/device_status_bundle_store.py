@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Optional
+
+from ._payload_utils import _normalize_status, _safe_str
+from .db_client import MSSQLConnector
+from .device_os_status_store import DeviceOsStatusStore, DeviceOsStatusUpsertResult
+from .device_status_store import DeviceStatusStore, DeviceStatusUpsertResult
+from .ingest_models import IngestEvent, SubtypeTag
+from .state_cache import UpsertStateCache
+from .time_utils import event_timestamp
+
+
+@dataclass(frozen=True, slots=True)
+class DeviceStatusBundleResult:
+    # None when the packet didn't carry that part.
+    status: DeviceStatusUpsertResult | None
+    os_status: DeviceOsStatusUpsertResult | None
+
+
+class DeviceStatusBundleStore:
+    """Writes dbo.device_status and dbo.device_os_status for one status packet.
+
+    Same behavior as DeviceStatusStore + DeviceOsStatusStore, but both upserts run
+    inside the dbo.upsert_device_status_bundle stored procedure, so a status
+    packet costs one round-trip instead of two. Parts that repeat the cached
+    value are left out of the call (and refreshed in a batch instead); a packet
+    with nothing new skips the call entirely. If the procedure doesn't exist
+    (bootstrap not re-run yet), the parts go through the DeviceStatusStore /
+    DeviceOsStatusStore MERGEs instead.
+    """
+
+    def __init__(
+        self, connector: MSSQLConnector, *, refresh_interval_seconds: float = 60.0
+    ) -> None:
+        self._logger = logging.getLogger("mqtt_ingest.device_status_bundle")
+        self._connector = connector
+        self._status_state = UpsertStateCache(
+            connector,
+            name="device_status",
+            touch_sql="""
+                UPDATE dbo.device_status
+                SET ts_epoch = ?, ts_datetime = ?, updated_at = SYSUTCDATETIME()
+                WHERE id = ?
+                """,
+            refresh_interval_seconds=refresh_interval_seconds,
+        )
+        self._os_state = UpsertStateCache(
+            connector,
+            name="device_os_status",
+            touch_sql="""
+                UPDATE dbo.device_os_status
+                SET ts_epoch = ?, ts_datetime = ?, updated_at = SYSUTCDATETIME()
+                WHERE id = ?
+                """,
+            refresh_interval_seconds=refresh_interval_seconds,
+        )
+        self._use_procedure = True
+        # Used only without the procedure. Caching stays with the states above,
+        # so these run uncached (refresh 0: no state, no flush thread).
+        self._status_fallback = DeviceStatusStore(connector, refresh_interval_seconds=0)
+        self._os_fallback = DeviceOsStatusStore(connector, refresh_interval_seconds=0)
+
+    def close(self) -> None:
+        self._status_state.close()
+        self._os_state.close()
+
+    def apply_from_event(
+        self, event: IngestEvent, *, device_id: int
+    ) -> Optional[DeviceStatusBundleResult]:
+        if event.subtype_tag != SubtypeTag.STATUS:
+            return None
+
+        payload = event.payload
+        if not isinstance(payload, dict):
+            return None
+
+        status = _normalize_status(payload.get("device_status"))
+        os_version = (_safe_str(payload.get("device_os_version")) or "").strip() or None
+        if status is None and os_version is None:
+            return None
+
+        ts_epoch, ts_dt = event_timestamp(event)
+        device_id = int(device_id)
+
+        cached_status_id = None
+        if status is not None:
+            cached_status_id = self._status_state.lookup(
+                device_id, status, ts_epoch=ts_epoch, ts_datetime=ts_dt
+            )
+        cached_os_id = None
+        if os_version is not None:
+            cached_os_id = self._os_state.lookup(
+                device_id, os_version, ts_epoch=ts_epoch, ts_datetime=ts_dt
+            )
+
+        # Only send the parts that changed; NULL tells the procedure to skip one.
+        call_status = status if cached_status_id is None else None
+        call_os_version = os_version if cached_os_id is None else None
+
+        status_result = None
+        if cached_status_id is not None:
+            status_result = DeviceStatusUpsertResult(
+                device_status_id=cached_status_id, created=False
+            )
+            self._logger.debug(
+                "Device status unchanged device_id=%s status=%s", device_id, status
+            )
+        os_result = None
+        if cached_os_id is not None:
+            os_result = DeviceOsStatusUpsertResult(
+                device_os_status_id=cached_os_id, created=False
+            )
+            self._logger.debug("Device OS unchanged device_id=%s", device_id)
+
+        if call_status is None and call_os_version is None:
+            return DeviceStatusBundleResult(status=status_result, os_status=os_result)
+
+        try:
+            row = None
+            if self._use_procedure:
+                row = self._call_procedure(
+                    device_id, call_status, call_os_version, int(ts_epoch), ts_dt
+                )
+            if row is None:
+                # No procedure on this database: the separate MERGEs (these
+                # stores log their own results).
+                if call_status is not None:
+                    status_result = self._status_fallback.upsert_status(
+                        device_id=device_id,
+                        status=call_status,
+                        ts_epoch=ts_epoch,
+                        ts_datetime=ts_dt,
+                    )
+                if call_os_version is not None:
+                    os_result = self._os_fallback.upsert_os_version(
+                        device_id=device_id,
+                        os_version=call_os_version,
+                        ts_epoch=ts_epoch,
+                        ts_datetime=ts_dt,
+                    )
+            else:
+                if call_status is not None:
+                    if row[0] is None:
+                        raise RuntimeError("Status bundle procedure returned no status id")
+                    status_result = DeviceStatusUpsertResult(
+                        device_status_id=int(row[0]), created=row[1] == "INSERT"
+                    )
+                    self._log_status(
+                        device_id, call_status, status_result, _safe_str(row[2])
+                    )
+                if call_os_version is not None:
+                    if row[3] is None:
+                        raise RuntimeError(
+                            "Status bundle procedure returned no OS status id"
+                        )
+                    os_result = DeviceOsStatusUpsertResult(
+                        device_os_status_id=int(row[3]), created=row[4] == "INSERT"
+                    )
+                    self._log_os(device_id, call_os_version, os_result, _safe_str(row[5]))
+        except Exception:
+            self._status_state.forget(device_id)
+            self._os_state.forget(device_id)
+            raise
+
+        # Cache only once committed (see DeviceStatusStore.upsert_status).
+        if call_status is not None and status_result is not None:
+            status_id = status_result.device_status_id
+            self._connector.after_commit(
+                lambda: self._status_state.remember(device_id, status_id, call_status)
+            )
+        if call_os_version is not None and os_result is not None:
+            os_status_id = os_result.device_os_status_id
+            self._connector.after_commit(
+                lambda: self._os_state.remember(device_id, os_status_id, call_os_version)
+            )
+
+        return DeviceStatusBundleResult(status=status_result, os_status=os_result)
+
+    def _call_procedure(
+        self,
+        device_id: int,
+        status: Optional[str],
+        os_version: Optional[str],
+        ts_epoch: int,
+        ts_datetime: datetime,
+    ) -> Any:
+        """Run dbo.upsert_device_status_bundle; None if it doesn't exist (yet)."""
+
+        sql = "{CALL dbo.upsert_device_status_bundle(?, ?, ?, ?, ?)}"
+
+        def _call(conn: Any) -> Any:
+            cur = self._connector.cursor_for(conn, sql)
+            cur.execute(sql, (device_id, os_version, status, ts_epoch, ts_datetime))
+            return cur.fetchone()
+
+        try:
+            # Both upserts in the procedure are MERGEs, so call() may retry it
+            # on a fresh connection if the pooled one went stale.
+            row = self._connector.call(_call)
+        except Exception as exc:
+            # 2812 = could not find stored procedure: the database predates the
+            # bootstrap that adds it. Anything else is a real failure.
+            if "(2812)" not in str(exc):
+                raise
+            self._use_procedure = False
+            self._logger.warning(
+                "dbo.upsert_device_status_bundle not found; "
+                "falling back to separate status / OS status upserts"
+            )
+            return None
+        if not row:
+            raise RuntimeError("Status bundle procedure returned no row")
+        return row
+
+    def _log_status(
+        self,
+        device_id: int,
+        status: str,
+        result: DeviceStatusUpsertResult,
+        prev_status: Optional[str],
+    ) -> None:
+        if result.created:
+            self._logger.info(
+                "Device status inserted id=%s device_id=%s status=%s",
+                result.device_status_id,
+                device_id,
+                status,
+            )
+        elif (prev_status or "").lower() != status:
+            self._logger.info(
+                "Device status changed device_id=%s %s -> %s",
+                device_id,
+                prev_status or "?",
+                status,
+            )
+        else:
+            self._logger.debug(
+                "Device status updated device_id=%s status=%s",
+                device_id,
+                status,
+            )
+
+    def _log_os(
+        self,
+        device_id: int,
+        os_version: str,
+        result: DeviceOsStatusUpsertResult,
+        prev_os: Optional[str],
+    ) -> None:
+        if result.created:
+            self._logger.info(
+                "Device OS inserted id=%s device_id=%s",
+                result.device_os_status_id,
+                device_id,
+            )
+        elif (prev_os or "") != os_version:
+            self._logger.info("Device OS changed device_id=%s", device_id)
+        else:
+            self._logger.debug("Device OS updated device_id=%s", device_id)
@@ -2,14 +2,17 @@ from __future__ import annotations
 
 import logging
 from dataclasses import dataclass
-from datetime import datetime, timezone
-from typing import Any, Mapping, Optional
+from datetime import datetime
+from typing import Any, Optional
 
+from ._payload_utils import _normalize_status, _safe_str
 from .db_client import MSSQLConnector
-from .ingest_models import IngestEvent
+from .ingest_models import IngestEvent, SubtypeTag
+from .state_cache import UpsertStateCache
+from .time_utils import event_timestamp
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class DeviceStatusUpsertResult:
     device_status_id: int
     created: bool
@@ -35,30 +38,38 @@ class DeviceStatusStore:
       - Sets offline_since:
           - when going offline: set if not already set
           - when online: clear
+      - Insert-or-update is a single MERGE round-trip.
+      - A packet repeating the cached status skips the MERGE; its timestamps are
+        refreshed in a batch every refresh_interval_seconds (see UpsertStateCache).
     """
 
-    def __init__(self, connector: MSSQLConnector) -> None:
+    def __init__(
+        self, connector: MSSQLConnector, *, refresh_interval_seconds: float = 60.0
+    ) -> None:
         self._logger = logging.getLogger("mqtt_ingest.device_status")
         self._connector = connector
-        self._conn: Any | None = None
+        self._state = UpsertStateCache(
+            connector,
+            name="device_status",
+            touch_sql="""
+                UPDATE dbo.device_status
+                SET ts_epoch = ?, ts_datetime = ?, updated_at = SYSUTCDATETIME()
+                WHERE id = ?
+                """,
+            refresh_interval_seconds=refresh_interval_seconds,
+        )
 
     def close(self) -> None:
-        if self._conn is None:
-            return
-        try:
-            self._conn.close()
-        except Exception:
-            pass
-        self._conn = None
+        self._state.close()
 
     def ensure_from_event(
         self, event: IngestEvent, *, device_id: int
     ) -> Optional[DeviceStatusUpsertResult]:
-        if (event.subtype or "") != "status":
+        if event.subtype_tag != SubtypeTag.STATUS:
             return None
 
         payload = event.payload
-        if not isinstance(payload, Mapping):
+        if not isinstance(payload, dict):
             return None
 
         status_raw = payload.get("device_status")
@@ -66,7 +77,7 @@ class DeviceStatusStore:
         if status is None:
             return None
 
-        ts_epoch, ts_dt = _event_timestamp(event)
+        ts_epoch, ts_dt = event_timestamp(event)
 
         return self.upsert_status(
             device_id=int(device_id),
@@ -83,48 +94,46 @@ class DeviceStatusStore:
         ts_epoch: int,
         ts_datetime: datetime,
     ) -> DeviceStatusUpsertResult:
-        conn = self._get_conn()
-
-        row = self._select_by_device_id(conn, device_id)
-        if row is None:
-            offline_since = ts_datetime if status == "offline" else None
-            status_id = self._insert_status(
-                conn,
-                device_id=device_id,
-                status=status,
-                ts_epoch=ts_epoch,
-                ts_datetime=ts_datetime,
-                offline_since=offline_since,
-            )
-            self._logger.info(
-                "Device status inserted id=%s device_id=%s status=%s",
-                status_id,
+        cached_id = self._state.lookup(
+            device_id, status, ts_epoch=ts_epoch, ts_datetime=ts_datetime
+        )
+        if cached_id is not None:
+            self._logger.debug(
+                "Device status unchanged device_id=%s status=%s",
                 device_id,
                 status,
             )
-            return DeviceStatusUpsertResult(device_status_id=status_id, created=True)
+            return DeviceStatusUpsertResult(device_status_id=cached_id, created=False)
 
-        status_id = int(row[0])
-        prev_status = _safe_str(row[1])
-        prev_offline_since = row[2]
-
-        if status == "offline":
-            offline_since = (
-                prev_offline_since if prev_offline_since is not None else ts_datetime
+        try:
+            # The MERGE is idempotent, so call() may retry it on a fresh
+            # connection if the pooled one went stale.
+            status_id, created, prev_status = self._connector.call(
+                lambda conn: self._merge_status(
+                    conn,
+                    device_id=device_id,
+                    status=status,
+                    ts_epoch=ts_epoch,
+                    ts_datetime=ts_datetime,
+                )
             )
-        else:
-            offline_since = None
-
-        self._update_status(
-            conn,
-            status_id=status_id,
-            status=status,
-            ts_epoch=ts_epoch,
-            ts_datetime=ts_datetime,
-            offline_since=offline_since,
+        except Exception:
+            self._state.forget(device_id)
+            raise
+        # Cache only once committed: a rolled-back event must not leave the
+        # cache claiming a row / value the table doesn't have.
+        self._connector.after_commit(
+            lambda: self._state.remember(device_id, status_id, status)
         )
 
-        if (prev_status or "").lower() != status:
+        if created:
+            self._logger.info(
+                "Device status inserted id=%s device_id=%s status=%s",
+                status_id,
+                device_id,
+                status,
+            )
+        elif (prev_status or "").lower() != status:
             self._logger.info(
                 "Device status changed device_id=%s %s -> %s",
                 device_id,
@@ -138,30 +147,9 @@ class DeviceStatusStore:
                 status,
             )
 
-        return DeviceStatusUpsertResult(device_status_id=status_id, created=False)
-
-    def _get_conn(self) -> Any:
-        if self._conn is None:
-            self._conn = self._connector.connect()
-            return self._conn
-
-        try:
-            self._conn.cursor()
-        except Exception:
-            self.close()
-            self._conn = self._connector.connect()
-
-        return self._conn
-
-    def _select_by_device_id(self, conn: Any, device_id: int) -> Any:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, status, offline_since FROM dbo.device_status WHERE device_id = ?",
-            (int(device_id),),
-        )
-        return cur.fetchone()
+        return DeviceStatusUpsertResult(device_status_id=status_id, created=created)
 
-    def _insert_status(
+    def _merge_status(
         self,
         conn: Any,
         *,
@@ -169,87 +157,54 @@ class DeviceStatusStore:
         status: str,
         ts_epoch: int,
         ts_datetime: datetime,
-        offline_since: datetime | None,
-    ) -> int:
-        cur = conn.cursor()
-        cur.execute(
+    ) -> tuple[int, bool, Optional[str]]:
+        """Insert-or-update in one round-trip, keeping offline_since in SQL.
+
+        Returns (id, created, previous status).
+        """
+
+        sql = """
+            MERGE dbo.device_status WITH (HOLDLOCK) AS tgt
+            USING (VALUES (?, ?, ?, ?)) AS src (device_id, status, ts_epoch, ts_datetime)
+                ON tgt.device_id = src.device_id
+            WHEN MATCHED THEN
+                UPDATE SET
+                    status = src.status,
+                    ts_epoch = src.ts_epoch,
+                    ts_datetime = src.ts_datetime,
+                    offline_since = CASE
+                        WHEN src.status = 'offline'
+                            THEN COALESCE(tgt.offline_since, src.ts_datetime)
+                        ELSE NULL
+                    END,
+                    updated_at = SYSUTCDATETIME()
+            WHEN NOT MATCHED THEN
+                INSERT (
+                    device_id,
+                    status,
+                    ts_epoch,
+                    ts_datetime,
+                    offline_since,
+                    created_at,
+                    updated_at
+                )
+                VALUES (
+                    src.device_id,
+                    src.status,
+                    src.ts_epoch,
+                    src.ts_datetime,
+                    CASE WHEN src.status = 'offline' THEN src.ts_datetime END,
+                    SYSUTCDATETIME(),
+                    SYSUTCDATETIME()
+                )
+            OUTPUT Inserted.id, $action, Deleted.status;
             """
-            INSERT INTO dbo.device_status (
-                device_id,
-                status,
-                ts_epoch,
-                ts_datetime,
-                offline_since,
-                created_at,
-                updated_at
-            )
-            OUTPUT Inserted.id
-            VALUES (?, ?, ?, ?, ?, SYSUTCDATETIME(), SYSUTCDATETIME())
-            """,
-            (int(device_id), status, int(ts_epoch), ts_datetime, offline_since),
+        cur = self._connector.cursor_for(conn, sql)
+        cur.execute(
+            sql,
+            (int(device_id), status, int(ts_epoch), ts_datetime),
         )
         row = cur.fetchone()
         if not row or row[0] is None:
-            raise RuntimeError("Insert succeeded but no id returned")
-        return int(row[0])
-
-    def _update_status(
-        self,
-        conn: Any,
-        *,
-        status_id: int,
-        status: str,
-        ts_epoch: int,
-        ts_datetime: datetime,
-        offline_since: datetime | None,
-    ) -> None:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            UPDATE dbo.device_status
-            SET status = ?,
-                ts_epoch = ?,
-                ts_datetime = ?,
-                offline_since = ?,
-                updated_at = SYSUTCDATETIME()
-            WHERE id = ?
-            """,
-            (status, int(ts_epoch), ts_datetime, offline_since, int(status_id)),
-        )
-
-
-def _normalize_status(value: Any) -> str | None:
-    if value is None:
-        return None
-    if isinstance(value, str):
-        v = value.strip().lower()
-    else:
-        try:
-            v = str(value).strip().lower()
-        except Exception:
-            return None
-
-    if v in {"online", "offline"}:
-        return v
-    return None
-
-
-def _event_timestamp(event: IngestEvent) -> tuple[int, datetime]:
-    if event.ts_ms is not None:
-        ts_dt = datetime.fromtimestamp(event.ts_ms / 1000.0, tz=timezone.utc)
-        ts_epoch = int(event.ts_ms // 1000)
-        return ts_epoch, ts_dt
-
-    now = datetime.now(timezone.utc)
-    return int(now.timestamp()), now
-
-
-def _safe_str(value: Any) -> Optional[str]:
-    if value is None:
-        return None
-    if isinstance(value, str):
-        return value
-    try:
-        return str(value)
-    except Exception:
-        return None
+            raise RuntimeError("Merge succeeded but no id returned")
+        return int(row[0]), row[1] == "INSERT", _safe_str(row[2])
@@ -2,14 +2,16 @@ from __future__ import annotations
 
 import logging
 from dataclasses import dataclass
-from datetime import datetime, timezone
+from datetime import datetime
 from typing import Any, Mapping, Optional, cast
 
+from ._payload_utils import _json_float, _json_str
 from .db_client import MSSQLConnector
-from .ingest_models import IngestEvent
+from .ingest_models import IngestEvent, SubtypeTag
+from .time_utils import event_timestamp
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class DeviceStorageUpsertResult:
     device_storage_id: int
     created: bool
@@ -37,24 +39,24 @@ class DeviceStorageStatusStore:
       - Only processes events with subtype == "storage" and payload.storage.
       - Each drive gets its own row, keyed by (device_id, drive).
       - New packets update existing rows (no history rows).
+      - Insert-or-update is a single MERGE round-trip per drive.
+      - A packet with several drives is sent as one table-valued parameter to
+        dbo.upsert_device_storage (one round-trip for all drives). If that
+        procedure doesn't exist yet (or use_tvp=False), the drives are staged
+        in a temp table with fast_executemany and merged in one statement.
     """
 
-    def __init__(self, connector: MSSQLConnector) -> None:
+    def __init__(self, connector: MSSQLConnector, *, use_tvp: bool = True) -> None:
         self._logger = logging.getLogger("mqtt_ingest.device_storage")
         self._connector = connector
-        self._conn: Any | None = None
+        self._use_tvp = bool(use_tvp)
 
     def close(self) -> None:
-        if self._conn is None:
-            return
-        try:
-            self._conn.close()
-        except Exception:
-            pass
-        self._conn = None
+        # Connections belong to the connector's pool; nothing to release here.
+        pass
 
     def ensure_from_event(self, event: IngestEvent, *, device_id: int) -> int:
-        if (event.subtype or "") != "storage":
+        if event.subtype_tag != SubtypeTag.STORAGE:
             return 0
 
         payload = event.payload
@@ -67,9 +69,12 @@ class DeviceStorageStatusStore:
 
         storage_map = cast(Mapping[str, Any], storage)
 
-        ts_epoch, ts_dt = _event_timestamp(event)
+        ts_epoch, ts_dt = event_timestamp(event)
 
-        upserts = 0
+        # Keyed by normalized drive: "C:" and "c:\\" are the same row, and a
+        # set-based MERGE can't take two source rows for one target (8672).
+        # The last entry for a drive wins, as it did with per-drive upserts.
+        rows_by_drive: dict[str, tuple[Any, ...]] = {}
         for drive, info in storage_map.items():
             drive_name = _normalize_drive(drive)
             if not drive_name:
@@ -78,34 +83,69 @@ class DeviceStorageStatusStore:
             if not isinstance(info, Mapping):
                 continue
 
-            info_map = cast(Mapping[str, Any], info)
+            get = cast(Mapping[str, Any], info).get
 
-            total_gb = _safe_float(info_map.get("total_gb"))
-            free_gb = _safe_float(info_map.get("free_gb"))
-            used_gb = _safe_float(info_map.get("used_gb"))
+            total_gb = _json_float(get("total_gb"))
+            free_gb = _json_float(get("free_gb"))
+            used_gb = _json_float(get("used_gb"))
 
             # payload uses used_pct; DB expects usage_percent
-            usage_percent = _safe_float(info_map.get("used_pct"))
+            usage_percent = _json_float(get("used_pct"))
 
             # Not currently provided in payload; leave NULL.
-            drive_type = _safe_str(info_map.get("drive_type"))
-            fmt = _safe_str(info_map.get("format"))
+            drive_type = _json_str(get("drive_type"))
+            fmt = _json_str(get("format"))
+
+            # Column order of dbo.DeviceStorageRowType.
+            rows_by_drive[drive_name] = (
+                int(device_id),
+                drive_name,
+                drive_type,
+                fmt,
+                total_gb,
+                free_gb,
+                used_gb,
+                usage_percent,
+                int(ts_epoch),
+                ts_dt,
+            )
 
+        rows = list(rows_by_drive.values())
+
+        if self._use_tvp and len(rows) > 1:
+            try:
+                self._upsert_drives_tvp(rows)
+                return len(rows)
+            except Exception as exc:
+                # 2812 = could not find stored procedure: the database predates
+                # the bootstrap that adds it. Anything else is a real failure.
+                if "(2812)" not in str(exc):
+                    raise
+                self._use_tvp = False
+                self._logger.warning(
+                    "dbo.upsert_device_storage not found; "
+                    "falling back to a staged MERGE per packet"
+                )
+
+        if len(rows) > 1:
+            self._upsert_drives_staged(rows)
+            return len(rows)
+
+        for row in rows:
             self.upsert_drive(
-                device_id=int(device_id),
-                drive=drive_name,
-                drive_type=drive_type,
-                format=fmt,
-                total_gb=total_gb,
-                free_gb=free_gb,
-                used_gb=used_gb,
-                usage_percent=usage_percent,
-                ts_epoch=ts_epoch,
-                ts_datetime=ts_dt,
+                device_id=row[0],
+                drive=row[1],
+                drive_type=row[2],
+                format=row[3],
+                total_gb=row[4],
+                free_gb=row[5],
+                used_gb=row[6],
+                usage_percent=row[7],
+                ts_epoch=row[8],
+                ts_datetime=row[9],
             )
-            upserts += 1
 
-        return upserts
+        return len(rows)
 
     def upsert_drive(
         self,
@@ -121,11 +161,8 @@ class DeviceStorageStatusStore:
         ts_epoch: int,
         ts_datetime: datetime,
     ) -> DeviceStorageUpsertResult:
-        conn = self._get_conn()
-
-        row = self._select_by_device_and_drive(conn, device_id=device_id, drive=drive)
-        if row is None:
-            storage_id = self._insert_drive(
+        storage_id, created = self._connector.call(
+            lambda conn: self._merge_drive(
                 conn,
                 device_id=device_id,
                 drive=drive,
@@ -138,60 +175,122 @@ class DeviceStorageStatusStore:
                 ts_epoch=ts_epoch,
                 ts_datetime=ts_datetime,
             )
+        )
+
+        self._log_drive(device_id, drive, storage_id, created)
+        return DeviceStorageUpsertResult(device_storage_id=storage_id, created=created)
+
+    def _upsert_drives_tvp(self, rows: list[tuple[Any, ...]]) -> None:
+        sql = "{CALL dbo.upsert_device_storage(?)}"
+
+        def _call(conn: Any) -> list[Any]:
+            cur = self._connector.cursor_for(conn, sql)
+            # pyodbc binds the list of tuples as the procedure's table-valued parameter.
+            cur.execute(sql, (rows,))
+            return cur.fetchall()
+
+        results = self._connector.call(_call)
+        for storage_id, action, drive in results:
+            self._log_drive(rows[0][0], drive, int(storage_id), action == "INSERT")
+
+    def _upsert_drives_staged(self, rows: list[tuple[Any, ...]]) -> None:
+        """Fallback batch path when dbo.upsert_device_storage isn't available.
+
+        Stages the rows in a session temp table with fast_executemany (all
+        parameter sets in one request), then merges them in one statement:
+        three round-trips per packet instead of one per drive.
+        """
+
+        stage_sql = """
+            IF OBJECT_ID(N'tempdb..#device_storage_rows') IS NULL
+                CREATE TABLE #device_storage_rows (
+                    device_id     INT NOT NULL,
+                    drive         NVARCHAR(10) NOT NULL,
+                    drive_type    NVARCHAR(50) NULL,
+                    format        NVARCHAR(20) NULL,
+                    total_gb      DECIMAL(10,2) NULL,
+                    free_gb       DECIMAL(10,2) NULL,
+                    used_gb       DECIMAL(10,2) NULL,
+                    usage_percent DECIMAL(5,2) NULL,
+                    ts_epoch      BIGINT NOT NULL,
+                    ts_datetime   DATETIME2 NOT NULL
+                );
+            ELSE
+                TRUNCATE TABLE #device_storage_rows;
+            """
+        insert_sql = """
+            INSERT INTO #device_storage_rows (
+                device_id, drive, drive_type, format,
+                total_gb, free_gb, used_gb, usage_percent,
+                ts_epoch, ts_datetime
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """
+        merge_sql = """
+            MERGE dbo.device_storage_status WITH (HOLDLOCK) AS tgt
+            USING #device_storage_rows AS src
+                ON tgt.device_id = src.device_id AND tgt.drive = src.drive
+            WHEN MATCHED THEN
+                UPDATE SET
+                    drive_type = src.drive_type,
+                    format = src.format,
+                    total_gb = src.total_gb,
+                    free_gb = src.free_gb,
+                    used_gb = src.used_gb,
+                    usage_percent = src.usage_percent,
+                    ts_epoch = src.ts_epoch,
+                    ts_datetime = src.ts_datetime,
+                    updated_at = SYSUTCDATETIME()
+            WHEN NOT MATCHED THEN
+                INSERT (
+                    device_id, drive, drive_type, format,
+                    total_gb, free_gb, used_gb, usage_percent,
+                    ts_epoch, ts_datetime, created_at, updated_at
+                )
+                VALUES (
+                    src.device_id, src.drive, src.drive_type, src.format,
+                    src.total_gb, src.free_gb, src.used_gb, src.usage_percent,
+                    src.ts_epoch, src.ts_datetime, SYSUTCDATETIME(), SYSUTCDATETIME()
+                )
+            OUTPUT Inserted.id, $action, Inserted.drive;
+            """
+
+        def _call(conn: Any) -> list[Any]:
+            with self._connector.transaction(conn):
+                # No parameters, so this runs as a plain batch and the temp
+                # table lives for the (pooled) session, not just this call.
+                self._connector.cursor_for(conn, stage_sql).execute(stage_sql)
+                cur = self._connector.cursor_for(conn, insert_sql)
+                cur.fast_executemany = True
+                cur.executemany(insert_sql, rows)
+                cur = self._connector.cursor_for(conn, merge_sql)
+                cur.execute(merge_sql)
+                return cur.fetchall()
+
+        results = self._connector.call(_call)
+        for storage_id, action, drive in results:
+            self._log_drive(rows[0][0], drive, int(storage_id), action == "INSERT")
+
+    def _log_drive(
+        self, device_id: int, drive: str, storage_id: int, created: bool
+    ) -> None:
+        if created:
             self._logger.info(
                 "Storage inserted id=%s device_id=%s drive=%s",
                 storage_id,
                 device_id,
                 drive,
             )
-            return DeviceStorageUpsertResult(device_storage_id=storage_id, created=True)
-
-        storage_id = int(row[0])
-        self._update_drive(
-            conn,
-            storage_id=storage_id,
-            drive_type=drive_type,
-            format=format,
-            total_gb=total_gb,
-            free_gb=free_gb,
-            used_gb=used_gb,
-            usage_percent=usage_percent,
-            ts_epoch=ts_epoch,
-            ts_datetime=ts_datetime,
-        )
-
-        self._logger.debug(
-            "Storage updated device_id=%s drive=%s",
-            device_id,
-            drive,
-        )
-
-        return DeviceStorageUpsertResult(device_storage_id=storage_id, created=False)
-
-    def _get_conn(self) -> Any:
-        if self._conn is None:
-            self._conn = self._connector.connect()
-            return self._conn
-
-        try:
-            self._conn.cursor()
-        except Exception:
-            self.close()
-            self._conn = self._connector.connect()
-
-        return self._conn
-
-    def _select_by_device_and_drive(
-        self, conn: Any, *, device_id: int, drive: str
-    ) -> Any:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id FROM dbo.device_storage_status WHERE device_id = ? AND drive = ?",
-            (int(device_id), drive),
-        )
-        return cur.fetchone()
+        elif self._logger.isEnabledFor(logging.DEBUG):
+            # Every drive of every storage packet lands here; skip the call
+            # entirely when DEBUG is off.
+            self._logger.debug(
+                "Storage updated device_id=%s drive=%s",
+                device_id,
+                drive,
+            )
 
-    def _insert_drive(
+    def _merge_drive(
         self,
         conn: Any,
         *,
@@ -205,11 +304,15 @@ class DeviceStorageStatusStore:
         usage_percent: float | None,
         ts_epoch: int,
         ts_datetime: datetime,
-    ) -> int:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO dbo.device_storage_status (
+    ) -> tuple[int, bool]:
+        """Insert-or-update one (device_id, drive) row in one round-trip.
+
+        Returns (id, created).
+        """
+
+        sql = """
+            MERGE dbo.device_storage_status WITH (HOLDLOCK) AS tgt
+            USING (VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)) AS src (
                 device_id,
                 drive,
                 drive_type,
@@ -219,13 +322,54 @@ class DeviceStorageStatusStore:
                 used_gb,
                 usage_percent,
                 ts_epoch,
-                ts_datetime,
-                created_at,
-                updated_at
+                ts_datetime
             )
-            OUTPUT Inserted.id
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, SYSUTCDATETIME(), SYSUTCDATETIME())
-            """,
+                ON tgt.device_id = src.device_id AND tgt.drive = src.drive
+            WHEN MATCHED THEN
+                UPDATE SET
+                    drive_type = src.drive_type,
+                    format = src.format,
+                    total_gb = src.total_gb,
+                    free_gb = src.free_gb,
+                    used_gb = src.used_gb,
+                    usage_percent = src.usage_percent,
+                    ts_epoch = src.ts_epoch,
+                    ts_datetime = src.ts_datetime,
+                    updated_at = SYSUTCDATETIME()
+            WHEN NOT MATCHED THEN
+                INSERT (
+                    device_id,
+                    drive,
+                    drive_type,
+                    format,
+                    total_gb,
+                    free_gb,
+                    used_gb,
+                    usage_percent,
+                    ts_epoch,
+                    ts_datetime,
+                    created_at,
+                    updated_at
+                )
+                VALUES (
+                    src.device_id,
+                    src.drive,
+                    src.drive_type,
+                    src.format,
+                    src.total_gb,
+                    src.free_gb,
+                    src.used_gb,
+                    src.usage_percent,
+                    src.ts_epoch,
+                    src.ts_datetime,
+                    SYSUTCDATETIME(),
+                    SYSUTCDATETIME()
+                )
+            OUTPUT Inserted.id, $action;
+            """
+        cur = self._connector.cursor_for(conn, sql)
+        cur.execute(
+            sql,
             (
                 int(device_id),
                 drive,
@@ -241,63 +385,25 @@ class DeviceStorageStatusStore:
         )
         row = cur.fetchone()
         if not row or row[0] is None:
-            raise RuntimeError("Insert succeeded but no id returned")
-        return int(row[0])
-
-    def _update_drive(
-        self,
-        conn: Any,
-        *,
-        storage_id: int,
-        drive_type: str | None,
-        format: str | None,
-        total_gb: float | None,
-        free_gb: float | None,
-        used_gb: float | None,
-        usage_percent: float | None,
-        ts_epoch: int,
-        ts_datetime: datetime,
-    ) -> None:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            UPDATE dbo.device_storage_status
-            SET drive_type = ?,
-                format = ?,
-                total_gb = ?,
-                free_gb = ?,
-                used_gb = ?,
-                usage_percent = ?,
-                ts_epoch = ?,
-                ts_datetime = ?,
-                updated_at = SYSUTCDATETIME()
-            WHERE id = ?
-            """,
-            (
-                drive_type,
-                format,
-                total_gb,
-                free_gb,
-                used_gb,
-                usage_percent,
-                int(ts_epoch),
-                ts_datetime,
-                int(storage_id),
-            ),
-        )
-
+            raise RuntimeError("Merge succeeded but no id returned")
+        return int(row[0]), row[1] == "INSERT"
 
-def _event_timestamp(event: IngestEvent) -> tuple[int, datetime]:
-    if event.ts_ms is not None:
-        ts_dt = datetime.fromtimestamp(event.ts_ms / 1000.0, tz=timezone.utc)
-        ts_epoch = int(event.ts_ms // 1000)
-        return ts_epoch, ts_dt
 
-    now = datetime.now(timezone.utc)
-    return int(now.timestamp()), now
+# The spellings agents actually send ("C", "c:", "C:\\", "C:/") -> drive letter,
+# so the common case is one dict lookup instead of the strip/upper checks below.
+_DRIVE_LOOKUP: dict[str, str] = {
+    f"{letter}{suffix}": letter.upper()
+    for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+    for suffix in ("", ":", ":\\", ":/")
+}
 
 
 def _normalize_drive(value: Any) -> Optional[str]:
+    if isinstance(value, str):
+        drive = _DRIVE_LOOKUP.get(value)
+        if drive is not None:
+            return drive
+
     if value is None:
         return None
     if isinstance(value, str):
@@ -323,27 +429,3 @@ def _normalize_drive(value: Any) -> Optional[str]:
         return None
 
     return drive
-
-
-def _safe_float(value: Any) -> float | None:
-    if value is None:
-        return None
-    if isinstance(value, bool):
-        return float(int(value))
-    if isinstance(value, (int, float)):
-        return float(value)
-    try:
-        return float(value)
-    except Exception:
-        return None
-
-
-def _safe_str(value: Any) -> str | None:
-    if value is None:
-        return None
-    if isinstance(value, str):
-        return value
-    try:
-        return str(value)
-    except Exception:
-        return None
@@ -7,6 +7,7 @@ from typing import Any, Optional
 
 from .db_client import MSSQLConnector
 from .ingest_models import IngestEvent
+from .state_cache import UpsertStateCache
 
 # ── Validation constants ───────────────────────────────────────────────────
 KNOWN_CUSTOMERS = {"PEPKOR", "PEP"}
@@ -61,7 +62,7 @@ def _validate_device(
     return True
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class DeviceUpsertResult:
     device_id: int
     created: bool
@@ -83,28 +84,42 @@ class DeviceStore:
       - If serial_number is missing, no-op.
       - If serial_number not found, insert row.
       - If found, update customer/location/machine_name and updated_at.
+      - Insert-or-update is a single MERGE round-trip.
+      - Every message carries the serial, but customer/location/machine rarely
+        change: a message repeating the cached values skips the MERGE and its
+        updated_at is refreshed in a batch every refresh_interval_seconds.
     """
 
-    def __init__(self, connector: MSSQLConnector) -> None:
+    def __init__(
+        self, connector: MSSQLConnector, *, refresh_interval_seconds: float = 60.0
+    ) -> None:
         self._logger = logging.getLogger("mqtt_ingest.devices")
         self._connector = connector
-        self._conn: Any | None = None
+        self._state = UpsertStateCache(
+            connector,
+            name="devices",
+            touch_sql="""
+                UPDATE dbo.devices
+                SET updated_at = SYSUTCDATETIME()
+                WHERE id = ?
+                """,
+            refresh_interval_seconds=refresh_interval_seconds,
+            touch_timestamps=False,
+        )
 
     def close(self) -> None:
-        if self._conn is None:
-            return
-        try:
-            self._conn.close()
-        except Exception:
-            pass
-        self._conn = None
+        self._state.close()
 
     def ensure_from_event(self, event: IngestEvent) -> Optional[DeviceUpsertResult]:
         serial = (event.serial_number or "").strip()
         if not serial:
             self._logger.debug(
-                "No serial_number in payload; skipping device upsert (topic=%s)",
-                f"{event.prefix}/{event.customer}/{event.location}/{event.machine}/{event.subtype}",
+                "No serial_number in payload; skipping device upsert (topic=%s/%s/%s/%s/%s)",
+                event.prefix,
+                event.customer,
+                event.location,
+                event.machine,
+                event.subtype,
             )
             return None
 
@@ -130,133 +145,102 @@ class DeviceStore:
         location: str,
         machine_name: str,
     ) -> DeviceUpsertResult:
-        conn = self._get_conn()
+        fields = (customer, location, machine_name)
+        cached_id = self._state.lookup(serial_number, fields)
+        if cached_id is not None:
+            return DeviceUpsertResult(device_id=cached_id, created=False)
 
-        # 1) Look up by serial
-        row = self._select_by_serial(conn, serial_number)
-        if row is None:
-            # 2) Insert if missing
-            try:
-                device_id = self._insert_device(
+        try:
+            device_id, created = self._connector.call(
+                lambda conn: self._merge_device(
                     conn,
                     serial_number=serial_number,
                     customer=customer,
                     location=location,
                     machine_name=machine_name,
                 )
-                self._logger.info(
-                    "Device inserted id=%s serial=%s customer=%s location=%s machine=%s",
-                    device_id,
-                    serial_number,
-                    customer,
-                    location,
-                    machine_name,
-                )
-                return DeviceUpsertResult(device_id=device_id, created=True)
-            except Exception:
-                # If another process inserted concurrently (or unique constraint), re-select.
-                self._logger.exception(
-                    "Device insert failed; retrying select/update (serial=%s)",
-                    serial_number,
-                )
-
-            row = self._select_by_serial(conn, serial_number)
-            if row is None:
-                raise
-
-        device_id = int(row[0])
-
-        # 3) Update to reflect latest metadata and bump updated_at.
-        self._update_device(
-            conn,
-            device_id=device_id,
-            customer=customer,
-            location=location,
-            machine_name=machine_name,
-        )
-
-        self._logger.debug(
-            "Device updated id=%s serial=%s customer=%s location=%s machine=%s",
-            device_id,
-            serial_number,
-            customer,
-            location,
-            machine_name,
-        )
-
-        return DeviceUpsertResult(device_id=device_id, created=False)
-
-    def _get_conn(self) -> Any:
-        if self._conn is None:
-            self._conn = self._connector.connect()
-            return self._conn
-
-        try:
-            self._conn.cursor()
+            )
         except Exception:
-            self.close()
-            self._conn = self._connector.connect()
-
-        return self._conn
-
-    def _select_by_serial(self, conn: Any, serial_number: str) -> Any:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, serial_number FROM dbo.devices WHERE serial_number = ?",
-            (serial_number,),
+            self._state.forget(serial_number)
+            raise
+        # Cache only once committed: a fresh insert (or changed fields) could
+        # still be rolled back with the surrounding event transaction.
+        self._connector.after_commit(
+            lambda: self._state.remember(serial_number, device_id, fields)
         )
-        return cur.fetchone()
 
-    def _insert_device(
-        self,
-        conn: Any,
-        *,
-        serial_number: str,
-        customer: str,
-        location: str,
-        machine_name: str,
-    ) -> int:
-        cur = conn.cursor()
-
-        # OUTPUT gives us the inserted identity value reliably.
-        cur.execute(
-            """
-            INSERT INTO dbo.devices (
+        if created:
+            self._logger.info(
+                "Device inserted id=%s serial=%s customer=%s location=%s machine=%s",
+                device_id,
                 serial_number,
                 customer,
                 location,
                 machine_name,
-                created_at,
-                updated_at
             )
-            OUTPUT Inserted.id
-            VALUES (?, ?, ?, ?, SYSUTCDATETIME(), SYSUTCDATETIME())
-            """,
-            (serial_number, customer, location, machine_name),
-        )
-        row = cur.fetchone()
-        if not row or row[0] is None:
-            raise RuntimeError("Insert succeeded but no id returned")
-        return int(row[0])
+        elif self._logger.isEnabledFor(logging.DEBUG):
+            # Runs for every message; skip the call when DEBUG is off.
+            self._logger.debug(
+                "Device updated id=%s serial=%s customer=%s location=%s machine=%s",
+                device_id,
+                serial_number,
+                customer,
+                location,
+                machine_name,
+            )
+
+        return DeviceUpsertResult(device_id=device_id, created=created)
 
-    def _update_device(
+    def _merge_device(
         self,
         conn: Any,
         *,
-        device_id: int,
+        serial_number: str,
         customer: str,
         location: str,
         machine_name: str,
-    ) -> None:
-        cur = conn.cursor()
-        cur.execute(
+    ) -> tuple[int, bool]:
+        """Insert-or-update by serial_number in one round-trip.
+
+        HOLDLOCK serializes concurrent upserts of the same serial, so there is
+        no insert race to retry. Returns (id, created).
+        """
+
+        sql = """
+            MERGE dbo.devices WITH (HOLDLOCK) AS tgt
+            USING (VALUES (?, ?, ?, ?)) AS src (serial_number, customer, location, machine_name)
+                ON tgt.serial_number = src.serial_number
+            WHEN MATCHED THEN
+                UPDATE SET
+                    customer = src.customer,
+                    location = src.location,
+                    machine_name = src.machine_name,
+                    updated_at = SYSUTCDATETIME()
+            WHEN NOT MATCHED THEN
+                INSERT (
+                    serial_number,
+                    customer,
+                    location,
+                    machine_name,
+                    created_at,
+                    updated_at
+                )
+                VALUES (
+                    src.serial_number,
+                    src.customer,
+                    src.location,
+                    src.machine_name,
+                    SYSUTCDATETIME(),
+                    SYSUTCDATETIME()
+                )
+            OUTPUT Inserted.id, $action;
             """
-            UPDATE dbo.devices
-            SET customer = ?,
-                location = ?,
-                machine_name = ?,
-                updated_at = SYSUTCDATETIME()
-            WHERE id = ?
-            """,
-            (customer, location, machine_name, int(device_id)),
+        cur = self._connector.cursor_for(conn, sql)
+        cur.execute(
+            sql,
+            (serial_number, customer, location, machine_name),
         )
+        row = cur.fetchone()
+        if not row or row[0] is None:
+            raise RuntimeError("Merge succeeded but no id returned")
+        return int(row[0]), row[1] == "INSERT"
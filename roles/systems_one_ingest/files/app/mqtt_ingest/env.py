@@ -4,6 +4,8 @@ import importlib
 import os
 from typing import Optional
 
+_TRUE_VALUES = frozenset({"1", "true", "yes", "y", "on"})
+
 
 def try_load_dotenv(*, override: bool = False) -> None:
     """Load .env if python-dotenv is installed.
@@ -22,7 +24,7 @@ def try_load_dotenv(*, override: bool = False) -> None:
 
 
 def is_truthy(value: Optional[str]) -> bool:
-    return (value or "").strip().lower() in {"1", "true", "yes", "y", "on"}
+    return (value or "").strip().lower() in _TRUE_VALUES
 
 
 def getenv_str(name: str, default: str = "") -> str:
@@ -35,3 +37,11 @@ def getenv_int(name: str, default: int) -> int:
         return int(raw)
     except ValueError:
         return default
+
+
+def getenv_float(name: str, default: float) -> float:
+    raw = getenv_str(name, str(default))
+    try:
+        return float(raw)
+    except ValueError:
+        return default
@@ -1,21 +1,48 @@
 from __future__ import annotations
 
 import json
+import sys
+import time
 from dataclasses import dataclass
-from datetime import datetime, timezone
-from typing import Any, Mapping, cast
+from enum import IntEnum
+from functools import lru_cache
+from typing import Any, Callable, Mapping, cast
 
+from ._payload_utils import _safe_float, _safe_int, _safe_str
 
-@dataclass(frozen=True)
+try:
+    import orjson
+except ImportError:  # optional; fall back to the stdlib parser
+    orjson = None  # type: ignore[assignment]
+
+
+class SubtypeTag(IntEnum):
+    """Known topic subtypes, resolved once per topic in parse_topic for cheap int checks."""
+
+    OTHER = 0
+    STATUS = 1
+    STATISTICS = 2
+    STORAGE = 3
+
+
+_SUBTYPE_TO_TAG: dict[str, SubtypeTag] = {
+    "status": SubtypeTag.STATUS,
+    "statistics": SubtypeTag.STATISTICS,
+    "storage": SubtypeTag.STORAGE,
+}
+
+
+@dataclass(frozen=True, slots=True)
 class TopicInfo:
     prefix: str
     customer: str
     location: str
     machine: str
     subtype: str
+    subtype_tag: SubtypeTag = SubtypeTag.OTHER
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class IngestEvent:
     prefix: str
     customer: str
@@ -31,113 +58,174 @@ class IngestEvent:
 
     payload: Mapping[str, Any] | None
 
+    subtype_tag: SubtypeTag = SubtypeTag.OTHER
+
     @property
     def ts_iso(self) -> str | None:
         if self.ts_ms is None:
             return None
+        # Formatted straight from gmtime; building an aware datetime just to
+        # strftime it costs two allocations per log line.
         try:
-            dt = datetime.fromtimestamp(self.ts_ms / 1000.0, tz=timezone.utc)
+            t = time.gmtime(self.ts_ms // 1000)
         except Exception:
             return None
-        return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return (
+            f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}"
+            f"T{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}Z"
+        )
+
+    def __str__(self) -> str:
+        # Lets callers log "%s" % event: logging only formats (and so only
+        # builds the line) when the record is actually emitted.
+        return self.to_log_line()
 
     def to_log_line(self) -> str:
         # Human-friendly one-liner for logs.
-        prefix = self.prefix
-        loc = f"{self.customer}/{self.location}/{self.machine}"
         retain = " R" if self.retain else ""
-        ts = self.ts_iso or "?"
-        serial = self.serial_number or "?"
-
-        if self.payload is None:
-            return f"{prefix} {loc} {self.subtype}{retain} ts={ts} sn={serial} payload=<unparsed>"
-
-        if self.subtype == "status":
-            status = _safe_str(self.payload.get("device_status"))
-            os_version = _safe_str(self.payload.get("device_os_version"))
-            os_part = (
-                f' os="{_short_os(os_version)}"' if os_version else ""
-            )
-            return (
-                f"{prefix} {loc} status{retain} ts={ts} sn={serial} "
-                f"state={_short_state(status)}{os_part}"
-            )
-
-        if self.subtype == "statistics":
-            stats = self.payload.get("statistics")
-            if isinstance(stats, Mapping):
-                stats_map = cast(Mapping[str, Any], stats)
-                total = _safe_int(stats_map.get("total_items"))
-                good = _safe_int(stats_map.get("good_reads"))
-                no_reads = _safe_int(stats_map.get("no_reads"))
-                out_of_spec = _safe_int(stats_map.get("out_of_spec"))
-                success = _safe_int(stats_map.get("success"))
-                sent = _safe_int(stats_map.get("sent"))
-                return (
-                    f"{prefix} {loc} statistics{retain} ts={ts} sn={serial} "
-                    f"total={_fmt_int(total)} good={_fmt_int(good)} nrd={_fmt_int(no_reads)} "
-                    f"oos={_fmt_int(out_of_spec)} ok={_fmt_int(success)} sent={_fmt_int(sent)}"
-                )
-            return f"{prefix} {loc} statistics{retain} ts={ts} sn={serial} statistics=<invalid>"
-
-        if self.subtype == "storage":
-            storage = self.payload.get("storage")
-            if isinstance(storage, Mapping):
-                storage_map = cast(Mapping[str, Any], storage)
-                parts: list[str] = []
-                for drive, info in storage_map.items():
-                    if not isinstance(info, Mapping):
-                        continue
-                    info_map = cast(Mapping[str, Any], info)
-                    used_pct = _safe_float(info_map.get("used_pct"))
-                    used_gb = _safe_float(info_map.get("used_gb"))
-                    total_gb = _safe_float(info_map.get("total_gb"))
-                    parts.append(
-                        f"{drive}: {(_fmt_float(used_pct) + '%') if used_pct is not None else '?'} "
-                        f"({(_fmt_float(used_gb) + 'GB') if used_gb is not None else '?'}"
-                        f"/{(_fmt_float(total_gb) + 'GB') if total_gb is not None else '?'})"
-                    )
-                joined = ", ".join(parts) if parts else "<empty>"
-                return f"{prefix} {loc} storage{retain} ts={ts} sn={serial} {joined}"
-            return f"{prefix} {loc} storage{retain} ts={ts} sn={serial} storage=<invalid>"
-
-        # Unknown subtype: keep it short but show keys.
-        keys = ",".join(sorted(self.payload.keys()))
-        return f"{prefix} {loc} {self.subtype}{retain} ts={ts} sn={serial} keys=[{keys}]"
+        head = (
+            f"{self.prefix} {self.customer}/{self.location}/{self.machine} "
+            f"{self.subtype}{retain} ts={self.ts_iso or '?'} sn={self.serial_number or '?'}"
+        )
+
+        payload = self.payload
+        if payload is None:
+            return f"{head} payload=<unparsed>"
+
+        return f"{head} {_SUBTYPE_FORMATTERS.get(self.subtype_tag, _format_unknown)(payload)}"
+
+
+def _format_status(payload: Mapping[str, Any]) -> str:
+    status = _safe_str(payload.get("device_status"))
+    os_version = _safe_str(payload.get("device_os_version"))
+    os_part = f' os="{_short_os(os_version)}"' if os_version else ""
+    return f"state={_short_state(status)}{os_part}"
+
+
+def _format_statistics(payload: Mapping[str, Any]) -> str:
+    stats = payload.get("statistics")
+    if not isinstance(stats, Mapping):
+        return "statistics=<invalid>"
+    stats_map = cast(Mapping[str, Any], stats)
+    total = _safe_int(stats_map.get("total_items"))
+    good = _safe_int(stats_map.get("good_reads"))
+    no_reads = _safe_int(stats_map.get("no_reads"))
+    out_of_spec = _safe_int(stats_map.get("out_of_spec"))
+    success = _safe_int(stats_map.get("success"))
+    sent = _safe_int(stats_map.get("sent"))
+    return (
+        f"total={_fmt_int(total)} good={_fmt_int(good)} nrd={_fmt_int(no_reads)} "
+        f"oos={_fmt_int(out_of_spec)} ok={_fmt_int(success)} sent={_fmt_int(sent)}"
+    )
+
+
+def _format_storage(payload: Mapping[str, Any]) -> str:
+    storage = payload.get("storage")
+    if not isinstance(storage, Mapping):
+        return "storage=<invalid>"
+    storage_map = cast(Mapping[str, Any], storage)
+    parts: list[str] = []
+    for drive, info in storage_map.items():
+        if not isinstance(info, Mapping):
+            continue
+        info_map = cast(Mapping[str, Any], info)
+        used_pct = _safe_float(info_map.get("used_pct"))
+        used_gb = _safe_float(info_map.get("used_gb"))
+        total_gb = _safe_float(info_map.get("total_gb"))
+        parts.append(
+            f"{drive}: {(_fmt_float(used_pct) + '%') if used_pct is not None else '?'} "
+            f"({(_fmt_float(used_gb) + 'GB') if used_gb is not None else '?'}"
+            f"/{(_fmt_float(total_gb) + 'GB') if total_gb is not None else '?'})"
+        )
+    return ", ".join(parts) if parts else "<empty>"
+
+
+def _format_unknown(payload: Mapping[str, Any]) -> str:
+    # Unknown subtype: keep it short but show keys.
+    keys = ",".join(sorted(payload.keys()))
+    return f"keys=[{keys}]"
+
+
+_SUBTYPE_FORMATTERS: dict[SubtypeTag, Callable[[Mapping[str, Any]], str]] = {
+    SubtypeTag.STATUS: _format_status,
+    SubtypeTag.STATISTICS: _format_statistics,
+    SubtypeTag.STORAGE: _format_storage,
+}
 
 
 def parse_topic(topic: str) -> TopicInfo | None:
     # Expected: systems-one/customer/location/machine/subtype
+    # The prefix is whatever INGEST_TOPICS subscribes to, so routing is keyed on
+    # the subtype segment: it is resolved to its SubtypeTag here, once per
+    # distinct topic (see _parse_topic_cached), and never again per message.
+    parts = (topic or "").strip("/").split("/", 4)
+    if (
+        len(parts) == 5
+        and "" not in parts
+        and not parts[4].startswith("/")
+        and "//" not in parts[4]
+    ):
+        prefix, customer, location, machine, subtype = parts
+        return TopicInfo(
+            prefix=prefix,
+            customer=customer,
+            location=location,
+            machine=machine,
+            subtype=sys.intern(subtype),
+            subtype_tag=_SUBTYPE_TO_TAG.get(subtype, SubtypeTag.OTHER),
+        )
+
+    # Odd shapes: drop empty segments ("a//b/...") and re-check the length.
     parts = [p for p in (topic or "").strip("/").split("/") if p]
     if len(parts) < 5:
         return None
     prefix, customer, location, machine = parts[0], parts[1], parts[2], parts[3]
-    subtype = "/".join(parts[4:])
+    subtype = sys.intern("/".join(parts[4:]))
     return TopicInfo(
         prefix=prefix,
         customer=customer,
         location=location,
         machine=machine,
         subtype=subtype,
+        subtype_tag=_SUBTYPE_TO_TAG.get(subtype, SubtypeTag.OTHER),
     )
 
 
 def parse_payload(payload_bytes: bytes) -> Mapping[str, Any] | None:
     if not payload_bytes:
         return None
+
+    if orjson is not None:
+        # orjson parses the bytes directly (no separate decode step). It rejects
+        # invalid UTF-8, so those payloads fall through to the lenient path below.
+        try:
+            obj = orjson.loads(payload_bytes)
+        except orjson.JSONDecodeError:
+            obj = _parse_payload_lenient(payload_bytes)
+    else:
+        obj = _parse_payload_lenient(payload_bytes)
+
+    if isinstance(obj, Mapping):
+        return cast(Mapping[str, Any], obj)
+    return None
+
+
+def _parse_payload_lenient(payload_bytes: bytes) -> Any:
     try:
         text = payload_bytes.decode("utf-8", errors="strict")
     except Exception:
         text = payload_bytes.decode("utf-8", errors="replace")
 
     try:
-        obj = json.loads(text)
+        return json.loads(text)
     except Exception:
         return None
 
-    if isinstance(obj, Mapping):
-        return cast(Mapping[str, Any], obj)
-    return None
+
+# A deployment publishes on a few thousand topics at most, so repeat messages
+# skip topic parsing entirely. TopicInfo is frozen, so sharing it is safe;
+# malformed topics are cached too (as None).
+_parse_topic_cached = lru_cache(maxsize=4096)(parse_topic)
 
 
 def build_event(
@@ -147,7 +235,7 @@ def build_event(
     qos: int | None = None,
     retain: bool | None = None,
 ) -> IngestEvent | None:
-    info = parse_topic(topic)
+    info = _parse_topic_cached(topic)
     if info is None:
         return None
 
@@ -165,6 +253,7 @@ def build_event(
         location=info.location,
         machine=info.machine,
         subtype=info.subtype,
+        subtype_tag=info.subtype_tag,
         serial_number=serial,
         ts_ms=ts_ms,
         qos=qos,
@@ -173,43 +262,6 @@ def build_event(
     )
 
 
-def _safe_str(value: Any) -> str | None:
-    if value is None:
-        return None
-    if isinstance(value, str):
-        return value
-    try:
-        return str(value)
-    except Exception:
-        return None
-
-
-def _safe_int(value: Any) -> int | None:
-    if value is None:
-        return None
-    if isinstance(value, bool):
-        return int(value)
-    if isinstance(value, int):
-        return value
-    try:
-        return int(value)
-    except Exception:
-        return None
-
-
-def _safe_float(value: Any) -> float | None:
-    if value is None:
-        return None
-    if isinstance(value, bool):
-        return float(int(value))
-    if isinstance(value, (int, float)):
-        return float(value)
-    try:
-        return float(value)
-    except Exception:
-        return None
-
-
 def _fmt_int(value: int | None) -> str:
     return "?" if value is None else str(value)
 
@@ -224,10 +276,13 @@ def _squash_ws(value: str) -> str:
     return " ".join(value.split())
 
 
+# A fleet reports a handful of distinct OS strings, so cache the trimmed form.
+@lru_cache(maxsize=256)
 def _short_os(value: str) -> str:
     text = _squash_ws(value)
-    if text.lower().startswith("microsoft "):
-        text = text[len("microsoft ") :]
+    # Only lower-case the prefix being compared, not the whole string.
+    if text[:10].lower() == "microsoft ":
+        text = text[10:]
     return _shorten(text, 48)
 
 
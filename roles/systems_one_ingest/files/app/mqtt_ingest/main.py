@@ -2,14 +2,95 @@ from __future__ import annotations
 
 import logging
 import os
-import time
+import signal
+import threading
 from dataclasses import replace
+from typing import Any
 
+from .env import getenv_float, getenv_int, is_truthy
 from .mqtt_client import MQTTConnector, params_from_env
 
+_LOG = logging.getLogger("mqtt_ingest")
 
-def _is_truthy(value: str | None) -> bool:
-    return (value or "").strip().lower() in {"1", "true", "yes", "y", "on"}
+
+def _setup_db() -> tuple[Any, dict[str, Any]]:
+    """Import the DB layer (once) and build the ingest stores.
+
+    Returns (ingest connector, MQTTConnector store kwargs); (None, {}) when
+    DB_ENABLE is off. Nothing DB-related is imported unless DB_CONNECT_ON_START
+    or DB_ENABLE is set, so the service still runs without pyodbc.
+    """
+
+    connect_on_start = is_truthy(os.getenv("DB_CONNECT_ON_START", "false"))
+    enabled = is_truthy(os.getenv("DB_ENABLE", "false"))
+    if not (connect_on_start or enabled):
+        return None, {}
+
+    from .db_client import MSSQLConnector, mssql_params_from_env
+
+    required = is_truthy(os.getenv("DB_CONNECT_REQUIRED", "false"))
+    db_connector = MSSQLConnector(mssql_params_from_env())
+
+    if connect_on_start:
+        try:
+            # Opens (and closes) its own connection; the pool isn't touched.
+            db_connector.test_connection()
+        except Exception:
+            _LOG.exception("MSSQL connection test failed")
+            if required:
+                db_connector.close()
+                raise
+
+    if not enabled:
+        db_connector.close()
+        return None, {}
+
+    from .device_store import DeviceStore
+    from .device_status_store import DeviceStatusStore
+    from .device_os_status_store import DeviceOsStatusStore
+    from .device_storage_status_store import DeviceStorageStatusStore
+    from .device_statistics_store import DeviceStatisticsStore
+    from .device_status_bundle_store import DeviceStatusBundleStore
+
+    # Repeated device / status / OS values skip the write; timestamps are
+    # refreshed in one batch per interval. 0 = write every packet.
+    refresh_seconds = getenv_float("DB_STATE_REFRESH_SECONDS", 60.0)
+
+    stores: dict[str, Any] = {
+        "device_store": DeviceStore(
+            db_connector, refresh_interval_seconds=refresh_seconds
+        ),
+        "device_storage_status_store": DeviceStorageStatusStore(db_connector),
+        "device_statistics_store": DeviceStatisticsStore(
+            db_connector,
+            batch_size=getenv_int("DB_STATS_BATCH_SIZE", 1),
+            flush_interval_seconds=getenv_float("DB_STATS_FLUSH_SECONDS", 5.0),
+            use_tvp=is_truthy(os.getenv("DB_STATS_TVP", "true")),
+        ),
+    }
+    # Needs dbo.upsert_device_status_bundle (mssql role bootstrap); turn off
+    # to fall back to the separate status / OS status upserts.
+    if is_truthy(os.getenv("DB_STATUS_BUNDLE", "true")):
+        stores["device_status_bundle_store"] = DeviceStatusBundleStore(
+            db_connector, refresh_interval_seconds=refresh_seconds
+        )
+    else:
+        stores["device_status_store"] = DeviceStatusStore(
+            db_connector, refresh_interval_seconds=refresh_seconds
+        )
+        stores["device_os_status_store"] = DeviceOsStatusStore(
+            db_connector, refresh_interval_seconds=refresh_seconds
+        )
+
+    # Connect before subscribing so the first message doesn't pay for it.
+    try:
+        db_connector.warmup()
+    except Exception:
+        _LOG.exception("MSSQL warmup failed")
+        if required:
+            raise
+
+    return db_connector, stores
 
 
 def main() -> int:
@@ -21,63 +102,36 @@ def main() -> int:
         format="%(asctime)s %(levelname)s %(name)s - %(message)s",
     )
 
-    if _is_truthy(os.getenv("DB_CONNECT_ON_START", "false")):
-        from .db_client import MSSQLConnector, mssql_params_from_env
-
-        required = _is_truthy(os.getenv("DB_CONNECT_REQUIRED", "false"))
-        try:
-            MSSQLConnector(mssql_params_from_env()).test_connection()
-        except Exception:
-            logging.getLogger("mqtt_ingest").exception("MSSQL connection test failed")
-            if required:
-                raise
-
-    device_store = None
-    device_status_store = None
-    device_os_status_store = None
-    device_storage_status_store = None
-    device_statistics_store = None
-    if _is_truthy(os.getenv("DB_ENABLE", "false")):
-        from .db_client import MSSQLConnector, mssql_params_from_env
-        from .device_store import DeviceStore
-        from .device_status_store import DeviceStatusStore
-        from .device_os_status_store import DeviceOsStatusStore
-        from .device_storage_status_store import DeviceStorageStatusStore
-        from .device_statistics_store import DeviceStatisticsStore
-
-        db_connector = MSSQLConnector(mssql_params_from_env())
-        device_store = DeviceStore(db_connector)
-        device_status_store = DeviceStatusStore(db_connector)
-        device_os_status_store = DeviceOsStatusStore(db_connector)
-        device_storage_status_store = DeviceStorageStatusStore(db_connector)
-        device_statistics_store = DeviceStatisticsStore(db_connector)
+    db_connector, stores = _setup_db()
+    event_transaction_connector = None
+    # Commit all writes for one message together instead of one autocommit
+    # per statement.
+    if db_connector is not None and is_truthy(
+        os.getenv("DB_EVENT_TRANSACTION", "true")
+    ):
+        event_transaction_connector = db_connector
 
     params = params_from_env()
     connector = MQTTConnector(
-        params,
-        device_store=device_store,
-        device_status_store=device_status_store,
-        device_os_status_store=device_os_status_store,
-        device_storage_status_store=device_storage_status_store,
-        device_statistics_store=device_statistics_store,
+        params, event_transaction_connector=event_transaction_connector, **stores
     )
     try:
         connector.connect(timeout_seconds=10.0)
     except TimeoutError:
-        transport = (params.transport or "").lower()
-        if params.port == 443 and ("ws" in transport) and not params.tls:
-            logging.getLogger("mqtt_ingest").warning(
+        if (
+            params.port == 443
+            and params.transport == "websockets"
+            and not params.tls
+        ):
+            _LOG.warning(
                 "MQTT connect timed out; retrying with TLS enabled (wss on port 443)"
             )
             connector.disconnect()
             params_tls = replace(params, tls=True)
             connector = MQTTConnector(
                 params_tls,
-                device_store=device_store,
-                device_status_store=device_status_store,
-                device_os_status_store=device_os_status_store,
-                device_storage_status_store=device_storage_status_store,
-                device_statistics_store=device_statistics_store,
+                event_transaction_connector=event_transaction_connector,
+                **stores,
             )
             connector.connect(timeout_seconds=10.0)
         else:
@@ -86,10 +140,20 @@ def main() -> int:
     if params.ingest_topics:
         connector.subscribe(params.ingest_topics, qos=params.ingest_qos)
     else:
-        logging.getLogger("mqtt_ingest").warning(
+        _LOG.warning(
             "No INGEST_TOPICS configured; connected but not subscribed to any topics"
         )
 
+    # SIGTERM (docker stop) / SIGINT end the run loop so the finally block
+    # below can flush and close the stores.
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            signal.signal(signum, lambda *_: stop.set())
+        except (ValueError, OSError):
+            # Not on the main thread / unsupported here; KeyboardInterrupt still works.
+            pass
+
     try:
         run_seconds_raw = os.getenv("RUN_SECONDS", "").strip()
         run_seconds: float | None
@@ -102,26 +166,19 @@ def main() -> int:
             run_seconds = None
 
         if run_seconds is not None and run_seconds > 0:
-            deadline = time.monotonic() + run_seconds
-            while time.monotonic() < deadline:
-                time.sleep(0.2)
+            stop.wait(timeout=run_seconds)
         else:
-            while True:
-                time.sleep(1)
+            stop.wait()
+        if stop.is_set():
+            _LOG.info("Shutting down...")
     except KeyboardInterrupt:
-        logging.getLogger("mqtt_ingest").info("Shutting down...")
+        _LOG.info("Shutting down...")
     finally:
         connector.disconnect()
-        if device_store is not None:
-            device_store.close()
-        if device_status_store is not None:
-            device_status_store.close()
-        if device_os_status_store is not None:
-            device_os_status_store.close()
-        if device_storage_status_store is not None:
-            device_storage_status_store.close()
-        if device_statistics_store is not None:
-            device_statistics_store.close()
+        for store in stores.values():
+            store.close()
+        if db_connector is not None:
+            db_connector.close()
 
     return 0
 
@@ -2,20 +2,32 @@ from __future__ import annotations
 
 import logging
 import os
+import queue
+import socket
 import ssl
 import threading
 from dataclasses import dataclass
 from typing import Optional
-from typing import Any, cast
+from typing import TYPE_CHECKING, Any, Callable
 
 import paho.mqtt.client as mqtt
 
-from .ingest_models import build_event
-from .device_store import DeviceStore
-from .device_status_store import DeviceStatusStore
-from .device_os_status_store import DeviceOsStatusStore
-from .device_storage_status_store import DeviceStorageStatusStore
-from .device_statistics_store import DeviceStatisticsStore
+from .ingest_models import IngestEvent, SubtypeTag, build_event
+
+if TYPE_CHECKING:
+    # Annotations only: the DB layer is imported by main._setup_db, and only
+    # when DB_ENABLE / DB_CONNECT_ON_START is set.
+    from .db_client import MSSQLConnector
+    from .device_store import DeviceStore
+    from .device_status_store import DeviceStatusStore
+    from .device_os_status_store import DeviceOsStatusStore
+    from .device_status_bundle_store import DeviceStatusBundleStore
+    from .device_storage_status_store import DeviceStorageStatusStore
+    from .device_statistics_store import DeviceStatisticsStore
+
+
+# (store call taking (event, device_id=...), log message if it raises)
+_SubtypeHandler = tuple[Callable[..., Any], str]
 
 
 @dataclass(frozen=True)
@@ -38,10 +50,32 @@ class MQTTConnectionParams:
     tls: bool = False
     tls_insecure: bool = False
 
+    # SO_RCVBUF for the broker socket, in bytes. 0 = leave the OS default (on
+    # Linux that keeps receive-buffer autotuning, which a fixed size disables).
+    socket_rcvbuf: int = 0
+
     # Ingest subscription configuration
     ingest_topics: tuple[str, ...] = ()
     ingest_qos: int = 0
 
+    # Worker threads that run the DB writes off the paho network thread.
+    # 0 = handle each message inline in on_message.
+    ingest_workers: int = 0
+    # Max events waiting per worker; further messages are dropped (and counted)
+    # instead of backing up into the network thread. 0 = unbounded.
+    ingest_queue_size: int = 10000
+
+    def __post_init__(self) -> None:
+        # Normalize once here so the connector (and anything reading params)
+        # can compare transport / tls_insecure directly.
+        transport = (self.transport or "tcp").strip().lower()
+        object.__setattr__(
+            self,
+            "transport",
+            "websockets" if transport in {"ws", "websocket", "websockets"} else "tcp",
+        )
+        object.__setattr__(self, "tls_insecure", bool(self.tls_insecure))
+
 
 class MQTTConnector:
     def __init__(
@@ -53,37 +87,72 @@ class MQTTConnector:
         device_os_status_store: DeviceOsStatusStore | None = None,
         device_storage_status_store: DeviceStorageStatusStore | None = None,
         device_statistics_store: DeviceStatisticsStore | None = None,
+        device_status_bundle_store: DeviceStatusBundleStore | None = None,
+        event_transaction_connector: MSSQLConnector | None = None,
     ) -> None:
         self._logger = logging.getLogger("mqtt_ingest.mqtt")
         self._params = params
         self._device_store = device_store
-        self._device_status_store = device_status_store
-        self._device_os_status_store = device_os_status_store
-        self._device_storage_status_store = device_storage_status_store
-        self._device_statistics_store = device_statistics_store
-
-        transport = (params.transport or "tcp").strip().lower()
-        if transport in {"ws", "websocket", "websockets"}:
-            transport = "websockets"
+        # When set, all store writes for one message run in one transaction.
+        self._event_transaction_connector = event_transaction_connector
+
+        # Subtype -> (store call, log message on failure), run in order after
+        # the device upsert. Status + OS status go through the bundle store
+        # (one stored procedure call) when it's configured.
+        status_handlers: list[_SubtypeHandler] = []
+        if device_status_bundle_store is not None:
+            status_handlers.append(
+                (
+                    device_status_bundle_store.apply_from_event,
+                    "Device status bundle upsert failed",
+                )
+            )
         else:
-            transport = "tcp"
+            if device_status_store is not None:
+                status_handlers.append(
+                    (device_status_store.ensure_from_event, "Device status upsert failed")
+                )
+            if device_os_status_store is not None:
+                status_handlers.append(
+                    (
+                        device_os_status_store.ensure_from_event,
+                        "Device OS status upsert failed",
+                    )
+                )
+        self._subtype_handlers: dict[SubtypeTag, tuple[_SubtypeHandler, ...]] = {
+            SubtypeTag.STATUS: tuple(status_handlers),
+        }
+        if device_storage_status_store is not None:
+            self._subtype_handlers[SubtypeTag.STORAGE] = (
+                (
+                    device_storage_status_store.ensure_from_event,
+                    "Device storage upsert failed",
+                ),
+            )
+        if device_statistics_store is not None:
+            self._subtype_handlers[SubtypeTag.STATISTICS] = (
+                (
+                    device_statistics_store.insert_from_event,
+                    "Device statistics insert failed",
+                ),
+            )
 
         self._client = mqtt.Client(
             client_id=params.client_id,
             clean_session=params.clean_session,
-            transport=transport,
+            transport=params.transport,
         )
 
         # Avoid tight reconnect loops when the broker drops the connection.
         self._client.reconnect_delay_set(min_delay=1, max_delay=30)
 
-        if transport == "websockets" and params.ws_path:
+        if params.transport == "websockets" and params.ws_path:
             self._client.ws_set_options(path=params.ws_path)
 
         if params.tls:
             context: ssl.SSLContext = ssl.create_default_context()
-            cast(Any, self._client).tls_set_context(context)
-            self._client.tls_insecure_set(bool(params.tls_insecure))
+            self._client.tls_set_context(context)  # type: ignore[attr-defined]
+            self._client.tls_insecure_set(params.tls_insecure)
 
         if params.username:
             self._client.username_pw_set(
@@ -95,9 +164,21 @@ class MQTTConnector:
 
         # Desired subscriptions are kept for the lifetime of the connector so that
         # we can re-subscribe on reconnect (required to keep receiving messages,
-        # including retained ones, after a disconnect).
+        # including retained ones, after a disconnect). Stored as an immutable
+        # snapshot that subscribe() replaces wholesale, so on_connect reads it
+        # without a lock; the lock only serializes writers.
         self._subscriptions_lock = threading.Lock()
-        self._desired_subscriptions: dict[str, int] = {}
+        self._desired_subscriptions: tuple[tuple[str, int], ...] = ()
+        # SUBSCRIBE mid -> the filters it carried, for per-topic SUBACK logging.
+        self._pending_subscribes_lock = threading.Lock()
+        self._pending_subscribes: dict[int, tuple[tuple[str, int], ...]] = {}
+
+        # Ingest lanes: one queue + worker thread each. A device always maps to
+        # the same lane, so its events are applied in order while writes for
+        # different devices overlap.
+        self._lanes: list[queue.Queue[IngestEvent | None]] = []
+        self._lane_threads: list[threading.Thread] = []
+        self._dropped = 0
 
         self._client.on_connect = self._on_connect
         self._client.on_disconnect = self._on_disconnect
@@ -112,9 +193,11 @@ class MQTTConnector:
             "Connecting to MQTT broker %s:%s (transport=%s)",
             self._params.host,
             self._params.port,
-            (self._params.transport or "tcp"),
+            self._params.transport,
         )
 
+        self._start_lanes()
+
         self._client.connect_async(
             self._params.host, self._params.port, self._params.keepalive
         )
@@ -158,29 +241,40 @@ class MQTTConnector:
         qos_int = 0 if qos_int < 0 else 2 if qos_int > 2 else qos_int
 
         with self._subscriptions_lock:
+            desired = dict(self._desired_subscriptions)
             for topic in normalized_topics:
                 # last one wins for qos
-                self._desired_subscriptions[topic] = qos_int
+                desired[topic] = qos_int
+            self._desired_subscriptions = tuple(desired.items())
 
         # If we're already connected, subscribe immediately.
         if self._connected_event.is_set() and (self._connect_rc == 0):
             self._subscribe_desired_subscriptions()
 
     def _subscribe_desired_subscriptions(self) -> None:
-        with self._subscriptions_lock:
-            items = list(self._desired_subscriptions.items())
-
+        items = self._desired_subscriptions
         if not items:
             return
 
-        for topic, qos in items:
-            result, _mid = self._client.subscribe(topic, qos=qos)
-            if result != mqtt.MQTT_ERR_SUCCESS:
-                self._logger.warning(
-                    "Failed to subscribe to topic '%s' (result=%s)", topic, result
-                )
-            else:
-                self._logger.info("Subscribe sent for '%s' (qos=%s)", topic, qos)
+        # All filters go in one SUBSCRIBE packet (one SUBACK) instead of one
+        # round-trip per topic. The lock keeps the SUBACK handler from looking
+        # up the mid before it's recorded.
+        with self._pending_subscribes_lock:
+            result, mid = self._client.subscribe(list(items))
+            if result == mqtt.MQTT_ERR_SUCCESS:
+                self._pending_subscribes[mid] = items
+
+        if result != mqtt.MQTT_ERR_SUCCESS:
+            self._logger.warning(
+                "Failed to subscribe to %s topic(s) (result=%s)", len(items), result
+            )
+        else:
+            self._logger.info(
+                "Subscribe sent for %s topic(s) mid=%s: %s",
+                len(items),
+                mid,
+                ", ".join(f"'{topic}' (qos={qos})" for topic, qos in items),
+            )
 
     def disconnect(self) -> None:
         try:
@@ -191,6 +285,44 @@ class MQTTConnector:
             self._client.loop_stop()
         except Exception:
             pass
+        # The network thread is stopped, so nothing new arrives; let the lanes
+        # finish what's queued before the caller closes the stores.
+        self._stop_lanes()
+
+    def _start_lanes(self) -> None:
+        if self._lane_threads:
+            return
+        for index in range(max(0, int(self._params.ingest_workers))):
+            lane: queue.Queue[IngestEvent | None] = queue.Queue(
+                maxsize=max(0, int(self._params.ingest_queue_size))
+            )
+            thread = threading.Thread(
+                target=self._run_lane,
+                args=(lane,),
+                name=f"mqtt-ingest-{index}",
+                daemon=True,
+            )
+            self._lanes.append(lane)
+            self._lane_threads.append(thread)
+            thread.start()
+
+    def _stop_lanes(self) -> None:
+        lanes, threads = self._lanes, self._lane_threads
+        self._lanes, self._lane_threads = [], []
+        for lane in lanes:
+            lane.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _run_lane(self, lane: queue.Queue[IngestEvent | None]) -> None:
+        while True:
+            event = lane.get()
+            if event is None:
+                return
+            try:
+                self._handle_event(event)
+            except Exception:
+                self._logger.exception("Ingest event handling failed")
 
     def _on_connect(
         self,
@@ -210,9 +342,38 @@ class MQTTConnector:
         self._connected_event.set()
 
         if int(rc) == 0:
+            self._tune_socket(client)
+            # SUBACKs owed by a previous connection will never arrive.
+            self._clear_pending_subscribes()
             # Always re-subscribe on connect/reconnect.
             self._subscribe_desired_subscriptions()
 
+    def _clear_pending_subscribes(self) -> None:
+        with self._pending_subscribes_lock:
+            self._pending_subscribes.clear()
+
+    def _tune_socket(self, client: mqtt.Client) -> None:
+        """Set TCP_NODELAY (and SO_RCVBUF if configured) on the broker socket.
+
+        paho opens a new socket on every (re)connect, so this runs from
+        on_connect. Options are set through a dup of the fd, which works the
+        same for plain, TLS and websocket transports.
+        """
+
+        sock = client.socket()
+        if sock is None:
+            return
+        try:
+            with socket.socket(fileno=os.dup(sock.fileno())) as raw:
+                # SUBACK/PUBACK and pings are tiny; don't let Nagle hold them.
+                raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if self._params.socket_rcvbuf > 0:
+                    raw.setsockopt(
+                        socket.SOL_SOCKET, socket.SO_RCVBUF, self._params.socket_rcvbuf
+                    )
+        except OSError:
+            self._logger.warning("Could not tune MQTT socket options", exc_info=True)
+
     def _on_disconnect(
         self,
         client: mqtt.Client,
@@ -222,6 +383,8 @@ class MQTTConnector:
     ) -> None:
         # Track current connection state so callers can reason about it.
         self._connected_event.clear()
+        # SUBACKs still outstanding died with the connection.
+        self._clear_pending_subscribes()
         if rc != 0:
             self._logger.warning("MQTT disconnected unexpectedly (rc=%s)", rc)
         else:
@@ -233,82 +396,95 @@ class MQTTConnector:
         userdata: object,
         msg: mqtt.MQTTMessage,
     ) -> None:
-        payload_bytes = msg.payload or b""
+        # Read each attribute once: MQTTMessage.topic decodes the raw topic
+        # bytes on every access. paho always delivers payload as bytes (b""
+        # when empty), so it needs no coercion.
+        topic = msg.topic
+        payload_bytes = msg.payload
+        qos = msg.qos
+        retain = msg.retain
         event = build_event(
-            topic=str(msg.topic),
+            topic=topic,
             payload_bytes=payload_bytes,
-            qos=getattr(msg, "qos", None),
-            retain=getattr(msg, "retain", None),
+            qos=qos,
+            retain=retain,
         )
 
         if event is None:
             # Topic doesn't match the expected format.
-            self._logger.info(
-                "[?] topic=%s retain=%s qos=%s bytes=%s",
-                msg.topic,
-                getattr(msg, "retain", None),
-                getattr(msg, "qos", None),
-                len(payload_bytes),
-            )
+            if self._logger.isEnabledFor(logging.INFO):
+                self._logger.info(
+                    "[?] topic=%s retain=%s qos=%s bytes=%s",
+                    topic,
+                    retain,
+                    qos,
+                    len(payload_bytes),
+                )
             return
 
-        if self._device_store is not None:
+        lanes = self._lanes
+        if lanes:
+            key = hash((event.customer, event.location, event.machine))
             try:
-                device_result = self._device_store.ensure_from_event(event)
-            except Exception:
-                # Don't kill the MQTT loop on transient DB issues.
-                self._logger.exception("Device upsert failed")
-                device_result = None
-
-            if (
-                device_result is not None
-                and self._device_status_store is not None
-                and (event.subtype == "status")
-            ):
-                try:
-                    self._device_status_store.ensure_from_event(
-                        event, device_id=device_result.device_id
+                lanes[key % len(lanes)].put_nowait(event)
+            except queue.Full:
+                # Never block the network thread on a slow database: drop and
+                # count, warning once per 1000 drops.
+                self._dropped += 1
+                if self._dropped % 1000 == 1:
+                    self._logger.warning(
+                        "Ingest queue full; dropping messages (dropped=%s)",
+                        self._dropped,
                     )
-                except Exception:
-                    self._logger.exception("Device status upsert failed")
-
-            if (
-                device_result is not None
-                and self._device_os_status_store is not None
-                and (event.subtype == "status")
-            ):
-                try:
-                    self._device_os_status_store.ensure_from_event(
-                        event, device_id=device_result.device_id
-                    )
-                except Exception:
-                    self._logger.exception("Device OS status upsert failed")
-
-            if (
-                device_result is not None
-                and self._device_storage_status_store is not None
-                and (event.subtype == "storage")
-            ):
-                try:
-                    self._device_storage_status_store.ensure_from_event(
-                        event, device_id=device_result.device_id
-                    )
-                except Exception:
-                    self._logger.exception("Device storage upsert failed")
-
-            if (
-                device_result is not None
-                and self._device_statistics_store is not None
-                and (event.subtype == "statistics")
-            ):
-                try:
-                    self._device_statistics_store.insert_from_event(
-                        event, device_id=device_result.device_id
-                    )
-                except Exception:
-                    self._logger.exception("Device statistics insert failed")
+            return
 
-        self._logger.info(event.to_log_line())
+        self._handle_event(event)
+
+    def _handle_event(self, event: IngestEvent) -> None:
+        connector = self._event_transaction_connector
+        if connector is not None and self._device_store is not None:
+            try:
+                with connector.event_transaction():
+                    self._apply_event(event)
+            except Exception as exc:
+                self._log_store_failure("Event transaction failed", exc)
+        else:
+            self._apply_event(event)
+
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info("%s", event)
+
+    def _apply_event(self, event: IngestEvent) -> None:
+        if self._device_store is None:
+            return
+
+        try:
+            device_result = self._device_store.ensure_from_event(event)
+        except Exception as exc:
+            # Don't kill the MQTT loop on transient DB issues.
+            self._log_store_failure("Device upsert failed", exc)
+            return
+        if device_result is None:
+            return
+
+        # Each store keeps its own try so one failing write doesn't skip the
+        # others (try blocks cost nothing until something raises).
+        for handler, failure in self._subtype_handlers.get(event.subtype_tag, ()):
+            try:
+                handler(event, device_id=device_result.device_id)
+            except Exception as exc:
+                self._log_store_failure(failure, exc)
+
+    def _log_store_failure(self, message: str, exc: Exception) -> None:
+        # Only reached with stores configured, so the DB layer is loaded by now.
+        from .db_client import is_connection_error
+
+        # While the database is down every message fails the same way; log
+        # those as one line and keep full tracebacks for unexpected errors.
+        if is_connection_error(exc):
+            self._logger.warning("%s: %s", message, exc)
+        else:
+            self._logger.exception(message)
 
     def _on_subscribe(
         self,
@@ -318,7 +494,19 @@ class MQTTConnector:
         granted_qos: tuple[int, ...] | list[int],
         properties: object | None = None,
     ) -> None:
-        self._logger.info("MQTT SUBACK mid=%s granted_qos=%s", mid, list(granted_qos))
+        with self._pending_subscribes_lock:
+            items = self._pending_subscribes.pop(mid, None)
+
+        if items is None:
+            self._logger.info("MQTT SUBACK mid=%s granted_qos=%s", mid, list(granted_qos))
+            return
+
+        for (topic, _qos), granted in zip(items, granted_qos):
+            # 0x80+ = the broker refused this filter (MQTT 5 passes ReasonCodes).
+            if int(getattr(granted, "value", granted)) >= 0x80:
+                self._logger.warning("MQTT SUBACK refused topic '%s'", topic)
+            else:
+                self._logger.info("MQTT SUBACK topic '%s' granted_qos=%s", topic, granted)
 
 
 def params_from_env() -> MQTTConnectionParams:
@@ -370,6 +558,24 @@ def params_from_env() -> MQTTConnectionParams:
         ingest_qos = 0
     ingest_qos = 0 if ingest_qos < 0 else 2 if ingest_qos > 2 else ingest_qos
 
+    ingest_workers_raw = _get("INGEST_WORKERS", "0")
+    try:
+        ingest_workers = max(0, int(ingest_workers_raw))
+    except ValueError:
+        ingest_workers = 0
+
+    socket_rcvbuf_raw = _get("MQTT_SOCKET_RCVBUF", "0")
+    try:
+        socket_rcvbuf = max(0, int(socket_rcvbuf_raw))
+    except ValueError:
+        socket_rcvbuf = 0
+
+    ingest_queue_size_raw = _get("INGEST_QUEUE_SIZE", "10000")
+    try:
+        ingest_queue_size = max(0, int(ingest_queue_size_raw))
+    except ValueError:
+        ingest_queue_size = 10000
+
     return MQTTConnectionParams(
         host=host,
         port=port,
@@ -382,6 +588,9 @@ def params_from_env() -> MQTTConnectionParams:
         ws_path=ws_path,
         tls=tls,
         tls_insecure=tls_insecure,
+        socket_rcvbuf=socket_rcvbuf,
         ingest_topics=ingest_topics,
         ingest_qos=ingest_qos,
+        ingest_workers=ingest_workers,
+        ingest_queue_size=ingest_queue_size,
     )
@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Any, Hashable, Optional
+
+from .db_client import MSSQLConnector
+
+
+class UpsertStateCache:
+    """Remembers the last value upserted per key so repeats can skip the write.
+
+    Status packets are mostly heartbeats carrying the same value as last time.
+    While a key's value is unchanged and its last full upsert is younger than
+    refresh_interval_seconds, lookup() returns the cached row id and only queues
+    a refresh of the row's timestamps. Queued refreshes are written with one
+    executemany of ``touch_sql`` (params: ts_epoch, ts_datetime, id, or just id
+    with touch_timestamps=False) every refresh_interval_seconds.
+
+    The cache is cleared whenever a refresh fails. Callers should forget() a
+    device whose upsert fails and remember() only once the write has committed
+    (MSSQLConnector.after_commit), so a DB error or a rolled-back event
+    transaction never leaves stale state behind.
+    refresh_interval_seconds <= 0 disables caching.
+    """
+
+    def __init__(
+        self,
+        connector: MSSQLConnector,
+        *,
+        name: str,
+        touch_sql: str,
+        refresh_interval_seconds: float = 60.0,
+        touch_timestamps: bool = True,
+    ) -> None:
+        self._logger = logging.getLogger(f"mqtt_ingest.state_cache.{name}")
+        self._connector = connector
+        self._touch_sql = touch_sql
+        self._refresh_interval_seconds = float(refresh_interval_seconds)
+        self._touch_timestamps = bool(touch_timestamps)
+
+        # key -> (row id, value, monotonic time of the last full upsert)
+        self._entries: dict[Hashable, tuple[int, Hashable, float]] = {}
+        # row id -> (ts_epoch, ts_datetime) of the newest skipped packet
+        self._touches: dict[int, tuple[Optional[int], Optional[datetime]]] = {}
+        self._lock = threading.Lock()
+
+        self._flush_stop = threading.Event()
+        self._flush_thread: threading.Thread | None = None
+        if self._refresh_interval_seconds > 0:
+            self._flush_thread = threading.Thread(
+                target=self._flush_loop,
+                name=f"state-cache-{name}",
+                daemon=True,
+            )
+            self._flush_thread.start()
+
+    def lookup(
+        self,
+        key: Hashable,
+        value: Hashable,
+        *,
+        ts_epoch: Optional[int] = None,
+        ts_datetime: Optional[datetime] = None,
+    ) -> Optional[int]:
+        """Return the cached row id if ``value`` is unchanged (and queue a refresh)."""
+
+        if self._refresh_interval_seconds <= 0:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != value:
+                return None
+            if time.monotonic() - entry[2] >= self._refresh_interval_seconds:
+                return None
+            self._touches[entry[0]] = (ts_epoch, ts_datetime)
+            return entry[0]
+
+    def remember(self, key: Hashable, row_id: int, value: Hashable) -> None:
+        if self._refresh_interval_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (row_id, value, time.monotonic())
+            # The full upsert just wrote newer timestamps.
+            self._touches.pop(row_id, None)
+
+    def forget(self, key: Hashable) -> None:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._touches.pop(entry[0], None)
+
+    def flush(self) -> int:
+        """Write queued timestamp refreshes. Returns the number of rows touched."""
+
+        with self._lock:
+            touches = self._touches
+            self._touches = {}
+
+        if not touches:
+            return 0
+
+        rows: list[tuple[Any, ...]]
+        if self._touch_timestamps:
+            rows = [
+                (int(ts_epoch), ts_dt, row_id)
+                for row_id, (ts_epoch, ts_dt) in touches.items()
+            ]
+        else:
+            rows = [(row_id,) for row_id in touches]
+
+        def _touch(conn: Any) -> None:
+            with self._connector.transaction(conn):
+                cur = self._connector.cursor_for(conn, self._touch_sql)
+                cur.fast_executemany = True
+                cur.executemany(self._touch_sql, rows)
+
+        try:
+            # Plain timestamp UPDATEs: safe for call() to retry on a fresh connection.
+            self._connector.call(_touch)
+        except Exception:
+            with self._lock:
+                self._entries.clear()
+            raise
+
+        self._logger.debug("Refreshed %s unchanged rows", len(rows))
+        return len(rows)
+
+    def close(self) -> None:
+        self._flush_stop.set()
+        if self._flush_thread is not None:
+            self._flush_thread.join(timeout=self._refresh_interval_seconds + 1.0)
+            self._flush_thread = None
+
+        try:
+            self.flush()
+        except Exception:
+            self._logger.exception("State cache flush on close failed")
+
+    def _flush_loop(self) -> None:
+        while not self._flush_stop.wait(self._refresh_interval_seconds):
+            try:
+                self.flush()
+            except Exception:
+                self._logger.exception("State cache flush failed")
@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from .ingest_models import IngestEvent
+
+
+@lru_cache(maxsize=64)
+def _timestamp_from_ms(ts_ms: int) -> tuple[int, datetime]:
+    # Several stores convert the same event, and with INGEST_WORKERS > 1 the
+    # lanes interleave different events, so keep a few recent conversions
+    # rather than just the last one. lru_cache is thread-safe.
+    return int(ts_ms // 1000), datetime.fromtimestamp(ts_ms / 1000.0, tz=timezone.utc)
+
+
+def event_timestamp(event: IngestEvent) -> tuple[int, datetime]:
+    """Return (epoch seconds, UTC datetime) for the event, or for now if it has no ts."""
+
+    ts_ms = event.ts_ms
+    if ts_ms is None:
+        now = datetime.now(timezone.utc)
+        return int(now.timestamp()), now
+    return _timestamp_from_ms(ts_ms)
@@ -0,0 +1,177 @@
+"""Make the mqtt_ingest package importable and provide a fake pyodbc connection."""
+import os
+import sys
+import threading
+import types
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "files", "app")
+)
+
+try:
+    import pyodbc  # noqa: F401
+except ModuleNotFoundError:
+    # Only the exception classes are needed (is_connection_error checks them);
+    # connections come from FakeServer below.
+    pyodbc = types.ModuleType("pyodbc")
+    pyodbc.Error = type("Error", (Exception,), {})
+    pyodbc.OperationalError = type("OperationalError", (pyodbc.Error,), {})
+    pyodbc.InterfaceError = type("InterfaceError", (pyodbc.Error,), {})
+    pyodbc.ProgrammingError = type("ProgrammingError", (pyodbc.Error,), {})
+    pyodbc.DataError = type("DataError", (pyodbc.Error,), {})
+    sys.modules["pyodbc"] = pyodbc
+
+from mqtt_ingest.db_client import MSSQLConnectionParams, MSSQLConnector  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.fast_executemany = False
+        self._rows = []
+
+    def execute(self, sql, *params):
+        self.conn.check_usable()
+        if self.conn.fail_execute is not None:
+            raise self.conn.fail_execute
+        if "XACT_STATE" in sql:
+            self._rows = [(self.conn.xact_state,)]
+            return self
+        result = self.conn.server.result_for(sql)
+        if isinstance(result, Exception):
+            raise result
+        self.conn.statements.append((sql, params))
+        self._rows = result if isinstance(result, list) else [result]
+        return self
+
+    def executemany(self, sql, rows):
+        self.conn.check_usable()
+        if self.conn.fail_executemany is not None:
+            raise self.conn.fail_executemany
+        self.conn.statements.append((sql, list(rows)))
+        if self.conn.autocommit:
+            self.conn.server.committed.extend(rows)
+        else:
+            self.conn.pending.extend(rows)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+
+class FakeConnection:
+    """Stands in for a pyodbc connection; tracks commits and rollbacks."""
+
+    def __init__(self, server, number):
+        self.server = server
+        self.number = number
+        self.autocommit = True
+        self.closed = False
+        self.commits = 0
+        self.rollbacks = 0
+        self.statements = []
+        self.xact_state = 1
+        self.fail_execute = None
+        self.fail_executemany = None
+        self.fail_commit = None
+        # executemany rows written since the last commit / rollback.
+        self.pending = []
+
+    def check_usable(self):
+        assert not self.closed, f"connection {self.number} used after close()"
+
+    def cursor(self):
+        self.check_usable()
+        return FakeCursor(self)
+
+    def commit(self):
+        self.check_usable()
+        self.server.committed.extend(self.pending)
+        self.pending = []
+        self.commits += 1
+        if self.fail_commit is not None:
+            # Applied on the server, but the acknowledgement never arrives.
+            raise self.fail_commit
+
+    def rollback(self):
+        self.check_usable()
+        self.pending = []
+        self.rollbacks += 1
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.server.closed(self)
+
+
+class FakeServer:
+    """Hands out FakeConnections and fails if more than max_open are live at once."""
+
+    def __init__(self, max_open):
+        self.max_open = max_open
+        self.opened = []
+        # executemany rows that were committed, across all connections.
+        self.committed = []
+        self.open_now = 0
+        self.peak_open = 0
+        # (substring, result) — checked in insertion order. A result is one
+        # row, a list of rows, or an exception for execute() to raise.
+        self.routes = []
+        self._lock = threading.Lock()
+
+    def route(self, substring, result):
+        self.routes.append((substring, result))
+        return self
+
+    def result_for(self, sql):
+        for sub, result in self.routes:
+            if sub in sql:
+                return result
+        return (1,)
+
+    def connect(self):
+        with self._lock:
+            self.open_now += 1
+            self.peak_open = max(self.peak_open, self.open_now)
+            assert self.open_now <= self.max_open, (
+                f"{self.open_now} connections open, pool_size is {self.max_open}"
+            )
+            conn = FakeConnection(self, len(self.opened))
+            self.opened.append(conn)
+            return conn
+
+    def closed(self, conn):
+        with self._lock:
+            self.open_now -= 1
+
+
+class FakeConnector(MSSQLConnector):
+    """MSSQLConnector whose connect() goes to a FakeServer instead of pyodbc."""
+
+    def __init__(self, params):
+        self.server = FakeServer(max(1, int(params.pool_size)))
+        super().__init__(params)
+
+    def connect(self):
+        return self.server.connect()
+
+
+@pytest.fixture
+def make_connector():
+    connectors = []
+
+    def _make(**overrides):
+        # Pruning off unless a test asks for it, so no background thread races it.
+        overrides.setdefault("pool_max_idle_seconds", 0)
+        overrides.setdefault("pool_timeout_seconds", 5.0)
+        connector = FakeConnector(MSSQLConnectionParams(host="fake", **overrides))
+        connectors.append(connector)
+        return connector
+
+    yield _make
+    for connector in connectors:
+        connector.close()
@@ -0,0 +1,98 @@
+import threading
+import time
+
+
+def test_pool_never_exceeds_size_or_hands_out_a_connection_twice(make_connector):
+    connector = make_connector(pool_size=3)
+    leased = set()
+    leased_lock = threading.Lock()
+    errors = []
+
+    def worker():
+        try:
+            for i in range(300):
+                with connector.lease() as conn:
+                    with leased_lock:
+                        assert conn not in leased, f"connection {conn.number} leased twice"
+                        leased.add(conn)
+                    if i % 7 == 0:
+                        time.sleep(0)
+                    with leased_lock:
+                        leased.discard(conn)
+        except BaseException as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=worker) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert 1 <= connector.server.peak_open <= 3
+
+
+class _CheckinBeforePut:
+    """Waiter queue that returns ``conn`` to the pool just before a waiter is queued."""
+
+    def __init__(self, connector, conn):
+        self._connector = connector
+        self._conn = conn
+        self._waiters = connector._waiters
+
+    def put(self, waiter):
+        # Same interleaving as another thread's lock-free _checkin() landing
+        # between _checkout_slow()'s idle check and its put().
+        self._connector._checkin(self._conn)
+        self._waiters.put(waiter)
+
+    def __getattr__(self, name):
+        return getattr(self._waiters, name)
+
+
+def test_checkin_racing_a_new_waiter_is_not_lost(make_connector):
+    connector = make_connector(pool_size=1, pool_timeout_seconds=0.5)
+    held = connector._checkout()
+    connector._waiters = _CheckinBeforePut(connector, held)
+
+    assert connector._checkout() is held
+    assert list(connector._idle) == []
+
+
+def test_broken_connections_free_their_slot(make_connector):
+    connector = make_connector(pool_size=2)
+    errors = []
+
+    def worker():
+        try:
+            for i in range(200):
+                try:
+                    with connector.lease() as conn:
+                        conn.cursor().execute("SELECT 1")
+                        if i % 3 == 0:
+                            raise ValueError("write failed")
+                except ValueError:
+                    pass
+        except BaseException as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert connector.server.peak_open <= 2
+    # Every failed lease closed its connection and a new one took the slot.
+    assert len(connector.server.opened) > 2
+
+
+def test_nested_lease_reuses_the_outer_connection(make_connector):
+    connector = make_connector(pool_size=1, pool_timeout_seconds=0.05)
+
+    with connector.lease() as outer:
+        with connector.lease() as inner:
+            assert inner is outer
+
+    assert len(connector.server.opened) == 1
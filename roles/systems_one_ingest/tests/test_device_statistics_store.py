@@ -0,0 +1,102 @@
+import pyodbc
+import pytest
+
+from mqtt_ingest.db_client import CommitUnknownError
+from mqtt_ingest.device_statistics_store import DeviceStatisticsStore
+
+
+def _row(n):
+    return (1, 1700000000 + n, None, n, 0, n, 0, 0, n, 0, 0, 0, 0, 0)
+
+
+def _make_store(connector):
+    # use_tvp=False: the fake records executemany batches; batch_size > 1
+    # would start the flush thread, so rows are queued by hand instead.
+    return DeviceStatisticsStore(connector, use_tvp=False)
+
+
+def _pooled_connection(connector):
+    with connector.lease() as conn:
+        return conn
+
+
+def test_batch_retried_when_connection_dies_before_commit(make_connector):
+    connector = make_connector(pool_size=1)
+    store = _make_store(connector)
+    stale = _pooled_connection(connector)
+    stale.fail_executemany = pyodbc.OperationalError("08S01", "link failure")
+    store._pending = [_row(1), _row(2)]
+
+    assert store.flush() == 2
+
+    assert connector.server.committed == [_row(1), _row(2)]
+    assert stale.closed
+
+
+def test_lost_commit_is_neither_retried_nor_requeued(make_connector):
+    connector = make_connector(pool_size=1)
+    store = _make_store(connector)
+    conn = _pooled_connection(connector)
+    conn.fail_commit = pyodbc.OperationalError("08S01", "link failure")
+    store._pending = [_row(1), _row(2)]
+
+    with pytest.raises(CommitUnknownError):
+        store.flush()
+
+    # Committed once by the first attempt; nothing left to insert it again.
+    assert connector.server.committed == [_row(1), _row(2)]
+    assert store._pending == []
+    assert len(connector.server.opened) == 1
+
+
+def test_connection_lost_after_retry_requeues_the_batch(make_connector):
+    connector = make_connector(pool_size=1)
+    store = _make_store(connector)
+    lost = pyodbc.OperationalError("08S01", "link failure")
+    original_connect = connector.server.connect
+
+    def connect_dead():
+        conn = original_connect()
+        conn.fail_executemany = lost
+        return conn
+
+    connector.server.connect = connect_dead
+    store._pending = [_row(1), _row(2)]
+
+    with pytest.raises(pyodbc.OperationalError):
+        store.flush()
+
+    assert store._pending == [_row(1), _row(2)]
+    assert connector.server.committed == []
+
+
+def test_bad_row_is_dropped_and_the_rest_written(make_connector):
+    connector = make_connector(pool_size=1)
+    store = _make_store(connector)
+    bad = _row(2)
+    original_connect = connector.server.connect
+
+    def connect_rejecting_bad_row():
+        conn = original_connect()
+        original_cursor = conn.cursor
+
+        def cursor():
+            cur = original_cursor()
+            original_executemany = cur.executemany
+
+            def executemany(sql, rows):
+                if bad in rows:
+                    raise pyodbc.DataError("22003", "value out of range")
+                original_executemany(sql, rows)
+
+            cur.executemany = executemany
+            return cur
+
+        conn.cursor = cursor
+        return conn
+
+    connector.server.connect = connect_rejecting_bad_row
+    store._pending = [_row(1), bad, _row(3)]
+
+    assert store.flush() == 2
+    assert connector.server.committed == [_row(1), _row(3)]
@@ -0,0 +1,111 @@
+import json
+
+import pyodbc
+import pytest
+
+from mqtt_ingest.device_status_bundle_store import DeviceStatusBundleStore
+from mqtt_ingest.ingest_models import build_event
+
+PROCEDURE = "dbo.upsert_device_status_bundle"
+
+
+def _status_event(**payload):
+    payload.setdefault("serial_number", "018389-01-8")
+    payload.setdefault("ts", 1700000000000)
+    return build_event(
+        topic="s1/PEP/HDH/DIM1/status", payload_bytes=json.dumps(payload).encode()
+    )
+
+
+def _procedure_calls(connector):
+    return [
+        params[0]
+        for conn in connector.server.opened
+        for sql, params in conn.statements
+        if PROCEDURE in sql
+    ]
+
+
+@pytest.fixture
+def store(make_connector):
+    connector = make_connector(pool_size=1)
+    store = DeviceStatusBundleStore(connector, refresh_interval_seconds=3600)
+    yield store
+    store._status_state._flush_stop.set()
+    store._os_state._flush_stop.set()
+
+
+def test_both_parts_go_in_one_call_and_repeats_skip_it(store):
+    connector = store._connector
+    connector.server.route(PROCEDURE, (11, "INSERT", None, 12, "INSERT", None))
+    event = _status_event(device_status="Online", device_os_version="Win 10")
+
+    result = store.apply_from_event(event, device_id=7)
+
+    assert result.status.device_status_id == 11 and result.status.created
+    assert result.os_status.device_os_status_id == 12 and result.os_status.created
+    ((device_id, os_version, status, ts_epoch, _),) = _procedure_calls(connector)
+    assert (device_id, os_version, status, ts_epoch) == (7, "Win 10", "online", 1700000000)
+
+    again = store.apply_from_event(event, device_id=7)
+    assert again.status.device_status_id == 11 and not again.status.created
+    assert again.os_status.device_os_status_id == 12
+    assert len(_procedure_calls(connector)) == 1
+
+
+def test_only_the_changed_part_is_sent(store):
+    connector = store._connector
+    connector.server.route(PROCEDURE, (11, "INSERT", None, 12, "INSERT", None))
+    store.apply_from_event(
+        _status_event(device_status="online", device_os_version="Win 10"), device_id=7
+    )
+    connector.server.routes[:] = [(PROCEDURE, (11, "UPDATE", "online", None, None, None))]
+
+    result = store.apply_from_event(
+        _status_event(device_status="offline", device_os_version="Win 10"), device_id=7
+    )
+
+    # NULL OS version: the procedure leaves that row alone.
+    assert _procedure_calls(connector)[-1][1:3] == (None, "offline")
+    assert result.status.device_status_id == 11 and not result.status.created
+    assert result.os_status.device_os_status_id == 12
+
+
+def test_missing_procedure_falls_back_to_separate_merges(store):
+    connector = store._connector
+    connector.server.route(
+        PROCEDURE,
+        pyodbc.ProgrammingError(
+            "42000", f"Could not find stored procedure '{PROCEDURE}'. (2812)"
+        ),
+    )
+    connector.server.route("MERGE dbo.device_status WITH", (21, "INSERT", None))
+    connector.server.route("MERGE dbo.device_os_status WITH", (22, "INSERT", None))
+
+    result = store.apply_from_event(
+        _status_event(device_status="online", device_os_version="Win 10"), device_id=7
+    )
+
+    assert store._use_procedure is False
+    assert result.status.device_status_id == 21
+    assert result.os_status.device_os_status_id == 22
+    # Cached like the procedure path: a repeat writes nothing.
+    statements = sum(len(conn.statements) for conn in connector.server.opened)
+    store.apply_from_event(
+        _status_event(device_status="online", device_os_version="Win 10"), device_id=7
+    )
+    assert sum(len(conn.statements) for conn in connector.server.opened) == statements
+
+
+def test_rolled_back_event_leaves_nothing_cached(store):
+    connector = store._connector
+    connector.server.route(PROCEDURE, (11, "INSERT", None, 12, "INSERT", None))
+    event = _status_event(device_status="online", device_os_version="Win 10")
+
+    with pytest.raises(ValueError):
+        with connector.event_transaction():
+            store.apply_from_event(event, device_id=7)
+            raise ValueError("later write failed")
+
+    store.apply_from_event(event, device_id=7)
+    assert len(_procedure_calls(connector)) == 2
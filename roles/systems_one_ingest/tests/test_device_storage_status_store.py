@@ -0,0 +1,93 @@
+import json
+from datetime import datetime, timezone
+
+import pyodbc
+
+from mqtt_ingest.device_storage_status_store import DeviceStorageStatusStore
+from mqtt_ingest.ingest_models import build_event
+
+TS_MS = 1700000000000
+TS_DT = datetime.fromtimestamp(TS_MS / 1000, tz=timezone.utc)
+
+
+def _storage_event(storage):
+    payload = {"serial_number": "018389-01-8", "ts": TS_MS, "storage": storage}
+    return build_event(
+        topic="s1/PEP/HDH/DIM1/storage",
+        payload_bytes=json.dumps(payload).encode(),
+    )
+
+
+def _row(drive, total, free, used, pct):
+    # Column order of dbo.DeviceStorageRowType.
+    return (7, drive, None, None, total, free, used, pct, TS_MS // 1000, TS_DT)
+
+
+def _sent_rows(conn, marker):
+    for sql, params in conn.statements:
+        if marker in sql:
+            return params
+    raise AssertionError(f"no statement containing {marker!r}")
+
+
+STORAGE = {
+    "C:": {"total_gb": 100, "free_gb": 40, "used_gb": 60, "used_pct": 60.0},
+    "d": {"total_gb": 200.5, "free_gb": 100.25, "used_gb": 100.25, "used_pct": 50},
+    # Same drive as "C:" once normalized: the last entry wins.
+    "c:\\": {"total_gb": 100, "free_gb": 30, "used_gb": 70, "used_pct": 70.0},
+    "bogus": {"total_gb": 1},
+    "E": "not a mapping",
+}
+EXPECTED_ROWS = [
+    _row("C", 100.0, 30.0, 70.0, 70.0),
+    _row("D", 200.5, 100.25, 100.25, 50.0),
+]
+
+
+def test_drives_go_to_the_procedure_as_one_deduped_tvp(make_connector):
+    connector = make_connector(pool_size=1)
+    connector.server.route(
+        "dbo.upsert_device_storage", [(1, "UPDATE", "C"), (2, "INSERT", "D")]
+    )
+    store = DeviceStorageStatusStore(connector)
+
+    assert store.ensure_from_event(_storage_event(STORAGE), device_id=7) == 2
+
+    (conn,) = connector.server.opened
+    # execute(sql, (rows,)): the row list is the procedure's one TVP argument.
+    assert _sent_rows(conn, "dbo.upsert_device_storage") == ((EXPECTED_ROWS,),)
+
+
+def test_missing_procedure_falls_back_to_the_staged_merge(make_connector):
+    connector = make_connector(pool_size=1)
+    connector.server.route(
+        "dbo.upsert_device_storage",
+        pyodbc.ProgrammingError(
+            "42000", "Could not find stored procedure 'dbo.upsert_device_storage'. (2812)"
+        ),
+    )
+    connector.server.route(
+        "MERGE dbo.device_storage_status", [(1, "UPDATE", "C"), (2, "INSERT", "D")]
+    )
+    store = DeviceStorageStatusStore(connector)
+
+    assert store.ensure_from_event(_storage_event(STORAGE), device_id=7) == 2
+    assert store._use_tvp is False
+
+    conn = connector.server.opened[-1]
+    assert _sent_rows(conn, "INSERT INTO #device_storage_rows") == EXPECTED_ROWS
+    # Stage, insert and merge commit together.
+    assert conn.commits == 1
+
+
+def test_single_drive_uses_one_merge(make_connector):
+    connector = make_connector(pool_size=1)
+    connector.server.route("MERGE dbo.device_storage_status", (5, "INSERT"))
+    store = DeviceStorageStatusStore(connector)
+
+    assert store.ensure_from_event(_storage_event({"C": STORAGE["C:"]}), device_id=7) == 1
+
+    (conn,) = connector.server.opened
+    ((sql, params),) = conn.statements
+    assert "MERGE dbo.device_storage_status" in sql
+    assert "#device_storage_rows" not in sql
@@ -0,0 +1,167 @@
+import pyodbc
+import pytest
+
+
+def test_event_without_writes_never_leases(make_connector):
+    connector = make_connector(pool_size=1)
+
+    with connector.event_transaction():
+        pass
+
+    assert connector.server.opened == []
+
+
+def test_event_begins_its_transaction_on_the_first_write(make_connector):
+    connector = make_connector(pool_size=1)
+
+    with connector.event_transaction():
+        with connector.lease() as first:
+            assert first.autocommit is False
+        with connector.lease() as second:
+            assert second is first
+        # The event keeps the connection until it ends.
+        assert list(connector._idle) == []
+
+    assert first.commits == 1
+    assert first.autocommit is True
+    assert [entry.conn for entry in connector._idle] == [first]
+
+
+def test_after_commit_runs_only_once_the_transaction_commits(make_connector):
+    connector = make_connector(pool_size=1)
+    ran = []
+
+    with connector.event_transaction():
+        with connector.lease() as conn:
+            connector.after_commit(lambda: ran.append("committed"))
+        assert ran == []
+    assert ran == ["committed"]
+    assert conn.commits == 1
+
+    with pytest.raises(ValueError):
+        with connector.event_transaction():
+            with connector.lease():
+                connector.after_commit(lambda: ran.append("rolled back"))
+            raise ValueError("event failed")
+    assert ran == ["committed"]
+
+    # Outside a transaction the callback runs straight away.
+    connector.after_commit(lambda: ran.append("autocommit"))
+    assert ran == ["committed", "autocommit"]
+
+
+def test_write_after_server_rollback_is_refused(make_connector):
+    connector = make_connector(pool_size=1)
+    ran = []
+
+    with pytest.raises(RuntimeError, match="already rolled back"):
+        with connector.event_transaction():
+            with pytest.raises(ValueError):
+                with connector.lease() as conn:
+                    connector.after_commit(lambda: ran.append("first"))
+                    conn.xact_state = 0  # e.g. chosen as deadlock victim
+                    raise ValueError("deadlock")
+            with connector.lease():
+                pass
+
+    assert ran == []
+    assert conn.commits == 0
+    assert conn.rollbacks == 1
+    assert conn.closed
+
+
+def test_commit_after_server_rollback_raises(make_connector):
+    connector = make_connector(pool_size=1)
+
+    with pytest.raises(RuntimeError, match="rolled back by the server"):
+        with connector.event_transaction():
+            try:
+                with connector.lease() as conn:
+                    conn.xact_state = -1
+                    raise ValueError("XACT_ABORT")
+            except ValueError:
+                pass
+
+    assert conn.commits == 0
+
+
+def test_failed_write_in_healthy_transaction_still_commits(make_connector):
+    connector = make_connector(pool_size=1)
+
+    with connector.event_transaction():
+        try:
+            with connector.lease() as conn:
+                raise ValueError("constraint violation")
+        except ValueError:
+            pass
+        with connector.lease():
+            pass
+
+    assert conn.commits == 1
+    assert conn.autocommit is True
+
+
+def _merge(conn):
+    return conn.cursor().execute("MERGE dbo.devices").fetchone()
+
+
+def test_stale_connection_is_replaced_on_the_events_first_write(make_connector):
+    connector = make_connector(pool_size=1)
+    with connector.lease() as stale:
+        stale.fail_execute = pyodbc.OperationalError("08S01", "link failure")
+
+    with connector.event_transaction():
+        assert connector.call(_merge) == (1,)
+        assert connector.call(_merge) == (1,)
+
+    stale_again, fresh = connector.server.opened
+    assert stale_again is stale and stale.closed
+    assert fresh.commits == 1
+    assert len(fresh.statements) == 2
+
+
+def test_connection_lost_after_the_first_write_fails_the_event(make_connector):
+    connector = make_connector(pool_size=1)
+
+    with pytest.raises(RuntimeError, match="already rolled back"):
+        with connector.event_transaction():
+            connector.call(_merge)
+            (conn,) = connector.server.opened
+            conn.fail_execute = pyodbc.OperationalError("08S01", "link failure")
+            # The first write is already in this transaction: no retry.
+            with pytest.raises(pyodbc.OperationalError):
+                connector.call(_merge)
+            connector.call(_merge)
+
+    assert connector.server.opened == [conn]
+    assert conn.commits == 0
+
+
+def test_repeated_device_packet_skips_the_event_transaction(make_connector):
+    from mqtt_ingest.device_store import DeviceStore
+    from mqtt_ingest.ingest_models import build_event
+    from mqtt_ingest.mqtt_client import MQTTConnectionParams, MQTTConnector
+
+    connector = make_connector(pool_size=1)
+    connector.server.route("MERGE dbo.devices", (7, "INSERT"))
+    device_store = DeviceStore(connector, refresh_interval_seconds=3600)
+    mqtt = MQTTConnector(
+        MQTTConnectionParams(host="broker", port=1883),
+        device_store=device_store,
+        event_transaction_connector=connector,
+    )
+    event = build_event(
+        topic="s1/PEP/HDH/DIM1/status",
+        payload_bytes=b'{"serial_number": "018389-01-8", "device_status": "online"}',
+    )
+
+    mqtt._handle_event(event)
+    (conn,) = connector.server.opened
+    assert conn.commits == 1
+    statements = len(conn.statements)
+
+    # Same values again: a state cache hit, so no lease, no SQL, no commit.
+    mqtt._handle_event(event)
+    assert conn.commits == 1
+    assert len(conn.statements) == statements
+    device_store._state._flush_stop.set()
@@ -0,0 +1,51 @@
+import itertools
+
+from mqtt_ingest.ingest_models import SubtypeTag, parse_topic
+
+
+def _baseline_parse_topic(topic):
+    # parse_topic as it was before the split fast path: drop empty segments,
+    # need at least five, everything after the machine is the subtype.
+    parts = [p for p in (topic or "").strip("/").split("/") if p]
+    if len(parts) < 5:
+        return None
+    return (parts[0], parts[1], parts[2], parts[3], "/".join(parts[4:]))
+
+
+def _fields(info):
+    if info is None:
+        return None
+    return (info.prefix, info.customer, info.location, info.machine, info.subtype)
+
+
+def test_parse_topic_matches_the_baseline_on_every_short_topic():
+    # Every string of up to 10 characters over "a", "/" and " " covers empty
+    # segments, leading/trailing/doubled slashes and blank-looking segments.
+    for length in range(11):
+        for chars in itertools.product("a/ ", repeat=length):
+            topic = "".join(chars)
+            assert _fields(parse_topic(topic)) == _baseline_parse_topic(topic), topic
+
+
+def test_parse_topic_matches_the_baseline_on_real_shapes():
+    topics = [
+        "systems-one/PEP/HDH/DIM1/status",
+        "systems-one/PEP/HDH/DIM1/statistics",
+        "/systems-one/PEP/HDH/DIM1/storage/",
+        "systems-one/PEP/HDH/DIM1/storage/drive/C",
+        "systems-one/PEP/HDH/DIM1//status",
+        "systems-one/PEP//HDH/DIM1/status",
+        "systems-one/PEP/HDH/DIM1/status//extra",
+        "systems-one/PEP/HDH/DIM1",
+        "",
+        None,
+    ]
+    for topic in topics:
+        assert _fields(parse_topic(topic)) == _baseline_parse_topic(topic), topic
+
+
+def test_parse_topic_resolves_the_subtype_tag():
+    assert parse_topic("s1/PEP/HDH/DIM1/status").subtype_tag is SubtypeTag.STATUS
+    assert parse_topic("s1/PEP/HDH/DIM1/statistics").subtype_tag is SubtypeTag.STATISTICS
+    assert parse_topic("s1/PEP/HDH/DIM1//storage").subtype_tag is SubtypeTag.STORAGE
+    assert parse_topic("s1/PEP/HDH/DIM1/status/x").subtype_tag is SubtypeTag.OTHER
@@ -0,0 +1,108 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from mqtt_ingest.ingest_models import build_event
+from mqtt_ingest.mqtt_client import MQTTConnectionParams, MQTTConnector
+
+
+class RecordingStore:
+    """Records every store call as (name, subtype, device_id)."""
+
+    def __init__(self, calls, name, *, fail=False):
+        self._calls = calls
+        self._name = name
+        self._fail = fail
+
+    def _record(self, event, *, device_id):
+        self._calls.append((self._name, event.subtype, device_id))
+        if self._fail:
+            raise ValueError(f"{self._name} failed")
+
+    ensure_from_event = _record
+    apply_from_event = _record
+    insert_from_event = _record
+
+
+class FakeDeviceStore:
+    def __init__(self, device_id=7):
+        self._device_id = device_id
+
+    def ensure_from_event(self, event):
+        if self._device_id is None:
+            return None
+        return SimpleNamespace(device_id=self._device_id)
+
+
+def _event(subtype):
+    return build_event(
+        topic=f"s1/PEP/HDH/DIM1/{subtype}",
+        payload_bytes=json.dumps({"serial_number": "018389-01-8"}).encode(),
+    )
+
+
+def _mqtt(calls, *, device_id=7, bundle=True, fail=()):
+    stores = {
+        name: RecordingStore(calls, name, fail=name in fail)
+        for name in (
+            "device_status_store",
+            "device_os_status_store",
+            "device_storage_status_store",
+            "device_statistics_store",
+        )
+    }
+    if bundle:
+        stores["device_status_bundle_store"] = RecordingStore(
+            calls, "device_status_bundle_store", fail="device_status_bundle_store" in fail
+        )
+    return MQTTConnector(
+        MQTTConnectionParams(host="broker", port=1883),
+        device_store=FakeDeviceStore(device_id),
+        **stores,
+    )
+
+
+@pytest.mark.parametrize(
+    "subtype, expected",
+    [
+        ("status", ["device_status_bundle_store"]),
+        ("storage", ["device_storage_status_store"]),
+        ("statistics", ["device_statistics_store"]),
+        ("Statistics", []),
+        ("config", []),
+    ],
+)
+def test_each_subtype_runs_only_its_own_stores(subtype, expected):
+    calls = []
+    _mqtt(calls)._handle_event(_event(subtype))
+
+    assert calls == [(name, subtype, 7) for name in expected]
+
+
+def test_status_without_bundle_runs_status_then_os_status():
+    calls = []
+    _mqtt(calls, bundle=False)._handle_event(_event("status"))
+
+    assert calls == [
+        ("device_status_store", "status", 7),
+        ("device_os_status_store", "status", 7),
+    ]
+
+
+def test_a_failing_store_does_not_skip_the_next_one():
+    calls = []
+    mqtt = _mqtt(calls, bundle=False, fail={"device_status_store"})
+    mqtt._handle_event(_event("status"))
+
+    assert [name for name, _, _ in calls] == [
+        "device_status_store",
+        "device_os_status_store",
+    ]
+
+
+def test_rejected_device_runs_no_stores():
+    calls = []
+    _mqtt(calls, device_id=None)._handle_event(_event("status"))
+
+    assert calls == []
@@ -0,0 +1,89 @@
+import threading
+import time
+
+
+def _wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out waiting for the pool"
+        time.sleep(0.001)
+
+
+def test_idle_connections_are_reused_most_recent_first(make_connector):
+    connector = make_connector(pool_size=2)
+    first = connector._checkout()
+    second = connector._checkout()
+    connector._checkin(first)
+    connector._checkin(second)
+
+    with connector.lease() as conn:
+        assert conn is second
+    with connector.lease() as conn:
+        assert conn is second
+
+
+def test_waiters_are_served_in_fifo_order(make_connector):
+    connector = make_connector(pool_size=1)
+    served = []
+
+    def worker(n):
+        with connector.lease():
+            served.append(n)
+
+    threads = []
+    with connector.lease():
+        for n in range(6):
+            thread = threading.Thread(target=worker, args=(n,))
+            thread.start()
+            threads.append(thread)
+            # Queue them one at a time so the arrival order is known.
+            _wait_until(lambda: connector._waiters.qsize() == n + 1)
+    for thread in threads:
+        thread.join()
+
+    assert served == list(range(6))
+    assert len(connector.server.opened) == 1
+
+
+def test_timed_out_waiter_is_skipped(make_connector):
+    connector = make_connector(pool_size=1, pool_timeout_seconds=0.05)
+    outcome = []
+
+    def worker():
+        try:
+            with connector.lease():
+                outcome.append("leased")
+        except TimeoutError:
+            outcome.append("timeout")
+
+    with connector.lease() as held:
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+
+    assert outcome == ["timeout"]
+    # The cancelled waiter must not swallow the returned connection.
+    with connector.lease() as conn:
+        assert conn is held
+
+
+def test_close_fails_waiting_callers(make_connector):
+    connector = make_connector(pool_size=1)
+    outcome = []
+
+    def worker():
+        try:
+            with connector.lease():
+                outcome.append("leased")
+        except RuntimeError as exc:
+            outcome.append(str(exc))
+
+    with connector.lease() as held:
+        thread = threading.Thread(target=worker)
+        thread.start()
+        _wait_until(lambda: connector._waiters.qsize() == 1)
+        connector.close()
+        thread.join()
+
+    assert outcome == ["MSSQL connection pool is closed"]
+    assert held.closed
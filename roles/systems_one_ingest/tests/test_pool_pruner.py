@@ -0,0 +1,58 @@
+import threading
+import time
+
+
+def _wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out waiting for the pool"
+        time.sleep(0.001)
+
+
+def test_pruner_closes_idle_connections_down_to_min_size(make_connector):
+    connector = make_connector(pool_size=3, pool_min_size=1, pool_max_idle_seconds=0.1)
+    barrier = threading.Barrier(3)
+
+    def worker():
+        with connector.lease():
+            barrier.wait()
+
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert connector.server.open_now == 3
+
+    _wait_until(lambda: connector.server.open_now == 1)
+    time.sleep(0.3)
+    assert connector.server.open_now == 1
+    with connector.lease() as conn:
+        assert not conn.closed
+
+
+def test_pruner_starts_with_the_first_pooled_connection(make_connector):
+    connector = make_connector(pool_max_idle_seconds=60)
+
+    # Direct connects (health check, diagnostics) never touch the pool.
+    connector.test_connection()
+    assert connector._prune_thread is None
+
+    with connector.lease():
+        pass
+    pruner = connector._prune_thread
+    assert pruner is not None and pruner.is_alive()
+
+    connector.close()
+    pruner.join(timeout=1.0)
+    assert not pruner.is_alive()
+
+
+def test_closed_connector_never_starts_a_pruner(make_connector):
+    connector = make_connector(pool_max_idle_seconds=60)
+    conn = connector._checkout()
+    connector.close()
+    connector._checkin(conn)
+
+    assert connector._prune_thread is None
+    assert conn.closed
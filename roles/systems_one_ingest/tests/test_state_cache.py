@@ -0,0 +1,142 @@
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from mqtt_ingest.state_cache import UpsertStateCache
+
+TOUCH_SQL = "UPDATE t SET ts_epoch = ?, ts = ? WHERE id = ?"
+
+
+@pytest.fixture
+def cache(make_connector):
+    connector = make_connector(pool_size=1)
+    # Long interval: the background flush never fires during a test.
+    cache = UpsertStateCache(
+        connector, name="test", touch_sql=TOUCH_SQL, refresh_interval_seconds=3600
+    )
+    yield cache
+    cache._flush_stop.set()
+
+
+def test_unchanged_value_hits_and_queues_a_touch(cache):
+    cache.remember("dev-1", 5, "online")
+    ts = datetime(2024, 1, 1, 12, 0, 0)
+
+    assert cache.lookup("dev-1", "online", ts_epoch=1704110400, ts_datetime=ts) == 5
+    assert cache.lookup("dev-1", "offline") is None
+    assert cache.lookup("dev-2", "online") is None
+
+    assert cache.flush() == 1
+    conn = cache._connector.server.opened[0]
+    assert conn.statements == [(TOUCH_SQL, [(1704110400, ts, 5)])]
+    assert conn.commits == 1
+    assert cache.flush() == 0
+
+
+def test_remember_drops_a_queued_touch(cache):
+    cache.remember("dev-1", 5, "online")
+    cache.lookup("dev-1", "online", ts_epoch=1, ts_datetime=None)
+    cache.remember("dev-1", 5, "online")
+
+    assert cache.flush() == 0
+
+
+def test_failed_touch_flush_clears_the_cache(cache):
+    cache.remember("dev-1", 5, "online")
+    cache.remember("dev-2", 6, "online")
+    assert cache.lookup("dev-1", "online", ts_epoch=1, ts_datetime=None) == 5
+
+    with cache._connector.lease() as conn:
+        conn.fail_executemany = ValueError("touch failed")
+
+    with pytest.raises(ValueError):
+        cache.flush()
+
+    assert cache.lookup("dev-1", "online") is None
+    assert cache.lookup("dev-2", "online") is None
+    assert conn.rollbacks == 1
+
+
+def test_forget_removes_entry_and_touch(cache):
+    cache.remember("dev-1", 5, "online")
+    cache.lookup("dev-1", "online", ts_epoch=1, ts_datetime=None)
+    cache.forget("dev-1")
+
+    assert cache.lookup("dev-1", "online") is None
+    assert cache.flush() == 0
+
+
+def test_touch_without_timestamps_sends_only_ids(make_connector):
+    connector = make_connector(pool_size=1)
+    cache = UpsertStateCache(
+        connector,
+        name="devices",
+        touch_sql="UPDATE t SET updated_at = SYSUTCDATETIME() WHERE id = ?",
+        refresh_interval_seconds=3600,
+        touch_timestamps=False,
+    )
+    cache.remember("sn-1", 5, ("PEP", "HDH", "DIM1"))
+    cache.remember("sn-2", 6, ("PEP", "HDH", "DIM2"))
+    cache.lookup("sn-1", ("PEP", "HDH", "DIM1"))
+    cache.lookup("sn-2", ("PEP", "HDH", "DIM2"))
+    cache._flush_stop.set()
+
+    assert cache.flush() == 2
+    (conn,) = connector.server.opened
+    assert conn.statements[-1][1] == [(5,), (6,)]
+
+
+def test_disabled_cache_never_hits(make_connector):
+    cache = UpsertStateCache(
+        make_connector(), name="off", touch_sql=TOUCH_SQL, refresh_interval_seconds=0
+    )
+    cache.remember("dev-1", 5, "online")
+
+    assert cache.lookup("dev-1", "online") is None
+
+
+def test_entry_older_than_the_refresh_interval_misses(cache):
+    cache.remember("dev-1", 5, "online")
+    row_id, value, _ = cache._entries["dev-1"]
+    cache._entries["dev-1"] = (row_id, value, time.monotonic() - 3601)
+
+    assert cache.lookup("dev-1", "online") is None
+
+
+def test_touches_queued_during_flushes_are_never_lost(cache):
+    keys = [f"dev-{n}" for n in range(20)]
+    for n, key in enumerate(keys):
+        cache.remember(key, n, "online")
+    done = threading.Event()
+
+    def worker():
+        for i in range(500):
+            key = keys[i % len(keys)]
+            assert cache.lookup(key, "online", ts_epoch=i, ts_datetime=None) is not None
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+
+    def flusher():
+        while not done.is_set():
+            cache.flush()
+
+    flush_thread = threading.Thread(target=flusher)
+    flush_thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    flush_thread.join()
+    cache.flush()
+
+    # Every thread's last lookup of a key carries the same ts, so the last
+    # refresh written for each row must be that one.
+    last_written = {}
+    for _, rows in cache._connector.server.opened[0].statements:
+        for ts_epoch, _, row_id in rows:
+            last_written[row_id] = ts_epoch
+    assert last_written == {n: 480 + n for n in range(len(keys))}
+    assert cache._touches == {}